@@ -0,0 +1,356 @@
+"""Open-loop load generator for server.py and server_udp.py.
+
+Requests are sent on a fixed schedule (rate per second) whether or not
+earlier ones have been answered, and latency is measured from the scheduled
+send time, so a server that falls behind shows up as queueing delay rather
+than as a slower request rate. Results are printed as JSON.
+
+Scenarios:
+    login-storm     every request is a login
+    steady-actions  users log in up front, then only perform actions
+    token-churn     actions, with every user logging in again every
+                    CHURN_ACTIONS actions; each replaced token is kept and
+                    sent once more after it has expired ("expired-action",
+                    answered with an error). Run the server with a
+                    "token_expiry" shorter than --duration so that phase runs
+
+    python benchmark.py --transport udp --scenario all --rate 2000 --duration 10
+"""
+import argparse
+import collections
+import itertools
+import json
+import math
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import requests
+import udp_wire
+
+SERVER_CONFIG_FILE = "server_config.json"
+SCENARIOS = ['login-storm', 'steady-actions', 'token-churn']
+CHURN_ACTIONS = 5  # Actions per token in the token-churn scenario
+
+
+class HTTPTransport:
+    """Sends requests from a thread pool, one keep-alive session per thread."""
+
+    def __init__(self, host, port, timeout, workers):
+        self.base_url = f"http://{host}:{port}"
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+
+    def submit(self, request):
+        """Returns a Future for the response dict, or None on timeout or connection error."""
+        return self.executor.submit(self.call, request)
+
+    def call(self, request):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        try:
+            if request['type'] == 'login':
+                response = session.post(f"{self.base_url}/login", timeout=self.timeout,
+                                        data={'username': request['username'], 'password': request['password']})
+            else:
+                response = session.get(f"{self.base_url}/action", timeout=self.timeout,
+                                       headers={'Authorization': f"Bearer {request['token']}"})
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class UDPTransport:
+    """Sends datagrams round-robin from sockets; a receiver thread per socket matches replies by request_id.
+
+    Several sockets (source ports) let SO_REUSEPORT spread the load over server workers.
+    """
+
+    def __init__(self, host, port, timeout, binary, server_name, sockets=1):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.binary = binary
+        self.server_name = server_name
+        self.client_id = str(uuid.uuid4())
+        self.socks = []
+        for _ in range(sockets):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.bind(('', 0))  # Ephemeral port: the server replies to the sender's address
+            sock.settimeout(0.05)
+            self.socks.append(sock)
+        self.next_sock = itertools.cycle(self.socks)
+        self.pending = {}  # request_id -> (Future, deadline)
+        self.lock = threading.Lock()
+        self.running = True
+        self.receivers = [threading.Thread(target=self.receive, args=(sock,), daemon=True) for sock in self.socks]
+        for receiver in self.receivers:
+            receiver.start()
+
+    def submit(self, request):
+        request = dict(request, request_id=str(uuid.uuid4()), client_id=self.client_id,
+                       server_name=self.server_name)
+        future = Future()
+        with self.lock:
+            self.pending[request['request_id']] = (future, time.monotonic() + self.timeout)
+        try:
+            next(self.next_sock).sendto(udp_wire.dumps(request, self.binary, self.server_name), self.address)
+        except OSError:
+            with self.lock:
+                self.pending.pop(request['request_id'], None)
+            future.set_result(None)
+        return future
+
+    def receive(self, sock):
+        next_reap = time.monotonic()
+        while self.running:
+            try:
+                data, _ = sock.recvfrom(65535)
+                response, _ = udp_wire.loads(data)
+                with self.lock:
+                    entry = self.pending.pop(response.get('request_id'), None)
+                if entry is not None:
+                    entry[0].set_result(response)
+            except socket.timeout:
+                pass
+            except (ValueError, AttributeError):
+                pass  # Malformed reply; its request will time out
+            now = time.monotonic()
+            if now >= next_reap:
+                self.reap(now)
+                next_reap = now + 0.05
+
+    def reap(self, now):
+        with self.lock:
+            expired = [request_id for request_id, (_, deadline) in self.pending.items() if deadline <= now]
+            futures = [self.pending.pop(request_id)[0] for request_id in expired]
+        for future in futures:
+            future.set_result(None)  # Lost or too late
+
+    def close(self):
+        self.running = False
+        for receiver in self.receivers:
+            receiver.join()
+        for sock in self.socks:
+            sock.close()
+
+
+class Scenario:
+    """A population of users cycling through the server's credentials."""
+
+    def __init__(self, name, credentials, users):
+        self.name = name
+        pairs = list(credentials.items())
+        self.users = [pairs[i % len(pairs)] for i in range(users)]
+        self.tokens = [None] * users
+        self.expires_at = [None] * users  # Monotonic time each user's token expires, if the server said
+        self.actions = [0] * users
+        self.retired = collections.deque()  # (expires_at, token) replaced in token-churn, in expiry order
+        self.lock = threading.Lock()
+        self.order = itertools.cycle(range(users))
+
+    def login_request(self, user):
+        username, password = self.users[user]
+        return {'type': 'login', 'username': username, 'password': password}
+
+    def warm_up(self, transport):
+        """Logs every user in before the measured run (action scenarios only)."""
+        if self.name == 'login-storm':
+            return
+        futures = [(user, transport.submit(self.login_request(user))) for user in range(len(self.users))]
+        wait([future for _, future in futures])
+        for user, future in futures:
+            self.handle(user, future.result())
+
+    def next_request(self):
+        """Returns (user, request, operation); user is None for requests that must not update a user."""
+        with self.lock:
+            if self.retired and self.retired[0][0] < time.monotonic():
+                _, expired_token = self.retired.popleft()
+                return None, {'type': 'action', 'token': expired_token}, 'expired-action'
+            user = next(self.order)
+            token = self.tokens[user]
+            if self.name == 'token-churn' and token is not None and self.actions[user] >= CHURN_ACTIONS:
+                if self.expires_at[user] is not None:
+                    self.retired.append((self.expires_at[user], token))  # Replay it once it has expired
+                self.tokens[user] = token = None  # Log in again
+            if token is not None:
+                self.actions[user] += 1
+        if self.name == 'login-storm' or token is None:
+            return user, self.login_request(user), 'login'
+        return user, {'type': 'action', 'token': token}, 'action'
+
+    def handle(self, user, response):
+        with self.lock:
+            if response is None or user is None:
+                return
+            if 'token' in response:
+                self.tokens[user] = response['token']
+                expires_in = response.get('expires_in')
+                self.expires_at[user] = time.monotonic() + expires_in if expires_in else None
+                self.actions[user] = 0
+            elif 'error' in response:
+                self.tokens[user] = None  # Expired or rejected: log in again next time
+
+
+class Recorder:
+    """Collects per-operation latencies and outcomes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # operation -> [seconds]
+        self.counts = {}  # (operation, outcome) -> count
+
+    def record(self, operation, latency, response):
+        if response is None:
+            outcome = 'timeout'
+        elif 'error' in response:
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+        with self.lock:
+            self.counts[operation, outcome] = self.counts.get((operation, outcome), 0) + 1
+            if response is not None:
+                self.latencies.setdefault(operation, []).append(latency)
+
+    def summary(self, latencies, counts, elapsed):
+        sent = sum(counts.values())
+        replies = sent - counts.get('timeout', 0)
+        return {
+            'sent': sent,
+            'ok': counts.get('ok', 0),
+            'errors': counts.get('error', 0),
+            'timeouts': counts.get('timeout', 0),
+            'timeout_rate': round(counts.get('timeout', 0) / sent, 4) if sent else 0.0,
+            'throughput_per_s': round(replies / elapsed, 1) if elapsed else 0.0,
+            'latency_ms': latency_summary(latencies),
+        }
+
+    def report(self, elapsed):
+        with self.lock:
+            latencies = {operation: list(values) for operation, values in self.latencies.items()}
+            counts = dict(self.counts)
+        operations = sorted({operation for operation, _ in counts})
+        result = self.summary([l for values in latencies.values() for l in values],
+                              aggregate(counts), elapsed)
+        result['operations'] = {
+            operation: self.summary(latencies.get(operation, []),
+                                    {outcome: n for (op, outcome), n in counts.items() if op == operation},
+                                    elapsed)
+            for operation in operations
+        }
+        return result
+
+
+def aggregate(counts):
+    """Sums (operation, outcome) counts per outcome."""
+    totals = {}
+    for (_, outcome), n in counts.items():
+        totals[outcome] = totals.get(outcome, 0) + n
+    return totals
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return None
+    values = sorted(latencies)
+    return {
+        'p50': round(percentile(values, 0.50) * 1000, 3),
+        'p95': round(percentile(values, 0.95) * 1000, 3),
+        'p99': round(percentile(values, 0.99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+        'mean': round(sum(values) / len(values) * 1000, 3),
+    }
+
+
+def run_scenario(name, transport, credentials, args):
+    """Drives one scenario at args.rate requests per second and returns its results."""
+    scenario = Scenario(name, credentials, args.users)
+    scenario.warm_up(transport)
+    recorder = Recorder()
+    futures = []
+    interval = 1.0 / args.rate
+    total = int(args.rate * args.duration)
+    start = time.perf_counter()
+
+    for i in range(total):
+        scheduled = start + i * interval
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)  # Otherwise we are behind schedule: send immediately
+        user, request, operation = scenario.next_request()
+
+        def done(future, user=user, operation=operation, scheduled=scheduled):
+            response = future.result()
+            recorder.record(operation, time.perf_counter() - scheduled, response)
+            scenario.handle(user, response)
+
+        future = transport.submit(request)
+        future.add_done_callback(done)
+        futures.append(future)
+
+    wait(futures)
+    result = {
+        'scenario': name,
+        'transport': args.transport,
+        'target_rate': args.rate,
+        'duration_s': args.duration,
+        'users': args.users,
+    }
+    result.update(recorder.report(time.perf_counter() - start))
+    return result
+
+
+def main():
+    with open(SERVER_CONFIG_FILE, "r") as f:
+        config = json.load(f)
+
+    parser = argparse.ArgumentParser(description="Open-loop benchmark for the Hack the City servers")
+    parser.add_argument('--transport', choices=['http', 'udp'], default='http')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help="Default: config port (HTTP) or 5005 (UDP)")
+    parser.add_argument('--scenario', choices=SCENARIOS + ['all'], default='all')
+    parser.add_argument('--rate', type=float, default=500, help="Requests per second")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per scenario")
+    parser.add_argument('--users', type=int, default=100, help="Simulated users")
+    parser.add_argument('--timeout', type=float, default=2.0, help="Seconds before a request counts as lost")
+    parser.add_argument('--workers', type=int, default=64, help="HTTP connections in flight")
+    parser.add_argument('--wire', choices=['json', 'binary'], default='json', help="UDP wire format")
+    parser.add_argument('--sockets', type=int, default=1,
+                        help="UDP source ports to send from (spreads load over server_udp.py --workers)")
+    parser.add_argument('--output', help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    if args.transport == 'http':
+        transport = HTTPTransport(args.host, args.port or config.get("port", 80), args.timeout, args.workers)
+    else:
+        transport = UDPTransport(args.host, args.port or 5005, args.timeout, args.wire == 'binary',
+                                 config.get("server_name"), args.sockets)
+
+    scenarios = SCENARIOS if args.scenario == 'all' else [args.scenario]
+    try:
+        results = [run_scenario(name, transport, config.get("credentials", {}), args) for name in scenarios]
+    finally:
+        transport.close()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == '__main__':
+    main()
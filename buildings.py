@@ -0,0 +1,139 @@
+"""Per-building state, so one server process can host several buildings.
+
+server_config.json describes the primary building. Its optional "buildings"
+list names further config files in the same format (building_name,
+server_name, credentials, token_* and failed_login_* keys). Each building
+gets its own credentials, token store and failed-login throttle; requests are
+routed to a building by server_name.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from token_store import create_token_store
+from throttle import create_login_throttle
+
+logger = logging.getLogger(__name__)
+
+
+class Building:
+    """Credentials, sessions and login throttling for one building."""
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config.get("building_name", "Generic Institution")
+        self.logo = config.get("building_logo", "institution_logo.png")
+        self.server_name = config.get("server_name")  # None accepts requests for any server_name
+        self.credentials = config.get("credentials", {})
+        self.token_expiry = config.get("token_expiry", 3600)  # Default: 1 hour
+        self.sliding_expiry = config.get("sliding_expiry", False)  # Each action pushes the expiry out again
+        self.token_snapshot = config.get("token_snapshot")  # None disables warm restarts
+        self.tokens = create_token_store(config)
+        self.login_throttle = create_login_throttle(config)
+
+    def restore_tokens(self):
+        """Loads the token snapshot, skipping tokens that expired while the server was down."""
+        if not self.token_snapshot:
+            return
+        try:
+            restored = self.tokens.load(self.token_snapshot)
+            if restored:
+                logger.info("Restored %s sessions from %s", restored, self.token_snapshot)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring token snapshot: {e}")
+
+    def save_tokens(self):
+        if not self.token_snapshot:
+            return
+        try:
+            self.tokens.save(self.token_snapshot)
+        except OSError as e:
+            logger.error(f"Could not save token snapshot: {e}")
+
+
+def load_configs(config):
+    """Returns config followed by the config of each file in its "buildings" list."""
+    configs = [config]
+    for path in config.get("buildings", []):
+        with open(path, "r") as f:
+            configs.append(json.load(f))
+    return configs
+
+
+def sessions_shared(configs):
+    """True if every building keeps sessions where other processes can see them (sqlite, or hmac with a secret)."""
+    for building_config in configs:
+        mode = building_config.get("token_mode", "memory")
+        if mode != "sqlite" and not (mode == "hmac" and building_config.get("token_secret")):
+            return False
+    return True
+
+
+def load_buildings(config):
+    """Returns {server_name: Building} for config and each file in its "buildings" list, primary first.
+
+    Raises OSError or ValueError if a config cannot be read or two buildings clash.
+    """
+    configs = load_configs(config)
+
+    server_names = set()
+    files = set()
+    for building_config in configs:
+        server_name = building_config.get("server_name")
+        if len(configs) > 1 and not server_name:
+            raise ValueError("Every building needs a server_name when one server hosts several")
+        if server_name in server_names:
+            raise ValueError(f"server_name '{server_name}' is used by more than one building")
+        server_names.add(server_name)
+        # Buildings must not share session files, or they would accept each other's tokens
+        building_files = [building_config.get("token_snapshot")]
+        if building_config.get("token_mode") == "sqlite":
+            building_files.append(building_config.get("token_db", "tokens.db"))
+        for path in filter(None, building_files):
+            if path in files:
+                raise ValueError(f"More than one building stores sessions in {path}")
+            files.add(path)
+
+    return {building_config.get("server_name"): Building(building_config) for building_config in configs}
+
+
+def building_stats(buildings):
+    """Dashboard statistics summed over buildings, with a session count per building when there are several."""
+    stats = {"Connected Clients": sum(len(building.tokens) for building in buildings.values())}
+    if len(buildings) > 1:
+        for building in buildings.values():
+            stats[f"{building.name} Clients"] = len(building.tokens)
+    for building in buildings.values():
+        for name, value in building.login_throttle.stats().items():
+            stats[name] = stats.get(name, 0) + value
+    return stats
+
+
+def expire_tokens(buildings, log=logger):
+    """Sweeps expired tokens once a second; only tokens that actually expired cost anything."""
+    while True:
+        for building in buildings.values():
+            for username in building.tokens.expire():
+                log.info("Token for %s expired", username)
+        time.sleep(1)
+
+
+def save_tokens(buildings):
+    for building in buildings.values():
+        building.save_tokens()
+
+
+def snapshot_tokens(buildings, interval):
+    """Saves the token tables every interval seconds so a restart keeps sessions."""
+    while True:
+        time.sleep(interval)
+        save_tokens(buildings)
+
+
+def start_token_threads(buildings, snapshot_interval, log=logger):
+    """Starts the expiry sweeper and, when a building has a token_snapshot, periodic and exit-time snapshots."""
+    threading.Thread(target=expire_tokens, args=(buildings, log), daemon=True).start()
+    if any(building.token_snapshot for building in buildings.values()):
+        threading.Thread(target=snapshot_tokens, args=(buildings, snapshot_interval), daemon=True).start()
+        atexit.register(save_tokens, buildings)  # Final snapshot on a clean shutdown
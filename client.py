@@ -1,20 +1,21 @@
 import threading
 import queue
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
 import time
-import tkinter as tk
-from PIL import Image, ImageTk
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import json
 import logging
+from token_cache import TokenCache
+from scheduler import RateScheduler
+import log_pipeline
 
-# Configure logging
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Configure logging (records are formatted and written off the client threads)
+log_pipeline.setup_logging()
 logger = logging.getLogger(__name__)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
 # Configuration and credential file paths
 SERVER_CONFIG_FILE = "client_config.json"
@@ -44,28 +45,69 @@ except json.JSONDecodeError:
     exit(1)
 
 # Global variables
-tokens = {}
+tokens = TokenCache()  # server_name + username -> token, reused until it nears expiry
 auth_success_count = 0
 actions_performed_count = 0
 log_queue = queue.Queue()
+counter_lock = threading.Lock()
 
+# One pooled keep-alive session per server address
+sessions = {}
+sessions_lock = threading.Lock()
+session_pool_size = 10
+MAX_BATCH_SIZE = 100  # Items per batch request; the server's default "max_batch_size"
 
-def log_message(message):
-    log_queue.put(message)
+# Rate-targeted scheduling with a circuit breaker per server, set by main() for --rate
+scheduler = None
+
+
+def log_message(message, *args):
+    logger.info(message, *args)  # Also reaches the dashboard through log_queue when it runs
+
+
+def get_session(server_address):
+    with sessions_lock:
+        session = sessions.get(server_address)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=session_pool_size)
+            session.mount('http://', adapter)
+            sessions[server_address] = session
+        return session
+
+
+def server_request(server_name, server_address, method, path, **kwargs):
+    """Sends one request and raises for HTTP errors, telling the server's circuit breaker whether it answered."""
+    session = get_session(server_address)
+    try:
+        response = session.request(method, f'http://{server_address}{path}', timeout=5, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        if scheduler is not None:
+            scheduler.breaker(server_name).record_failure()
+        raise
+    if scheduler is not None:
+        # Any HTTP reply, even an error, shows the server is up; 5xx means it is not healthy
+        if response.status_code >= 500:
+            scheduler.breaker(server_name).record_failure()
+        else:
+            scheduler.breaker(server_name).record_success()
+    response.raise_for_status()
+    return response
 
 
 def authenticate(server_name, server_address, username, password):
     global auth_success_count
     try:
-        response = requests.post(f'http://{server_address}/login', data={'username': username, 'password': password}, timeout=5)
-        response.raise_for_status()
-        token = response.json().get('token')
-        tokens[server_name + username] = token
-        auth_success_count += 1
-        log_message(f"SUCCESS: Authenticated {username} with {server_name}.")
+        response = server_request(server_name, server_address, 'POST', '/login', data={'username': username, 'password': password})
+        body = response.json()
+        token = body.get('token')
+        tokens.put(server_name + username, token, body.get('expires_in'))
+        with counter_lock:
+            auth_success_count += 1
+        log_message("SUCCESS: Authenticated %s with %s.", username, server_name)
         return token
     except requests.exceptions.RequestException as e:
-        log_message(f"ERROR: {server_name}: Authentication failed for {username}: {e}")
+        log_message("ERROR: %s: Authentication failed for %s: %s", server_name, username, e)
         return None
 
 
@@ -73,86 +115,212 @@ def perform_action(server_name, server_address, username, token):
     global actions_performed_count
     try:
         headers = {'Authorization': f'Bearer {token}'}
-        response = requests.get(f'http://{server_address}/action', headers=headers, timeout=5)
-        response.raise_for_status()
-        actions_performed_count += 1
-        log_message(f"SUCCESS: Performed action on {server_name} as {username}.")
+        response = server_request(server_name, server_address, 'GET', '/action', headers=headers)
+        expires_in = response.json().get('expires_in')
+        if expires_in is not None:
+            tokens.put(server_name + username, token, expires_in)  # Sliding expiry: the session was extended
+        with counter_lock:
+            actions_performed_count += 1
+        log_message("SUCCESS: Performed action on %s as %s.", server_name, username)
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 401:
+            tokens.invalidate(server_name + username)  # Log in again on the next cycle
+        log_message("ERROR: %s: Action failed for %s: %s", server_name, username, e)
+    except requests.exceptions.RequestException as e:
+        log_message("ERROR: %s: Action failed for %s: %s", server_name, username, e)
+
+
+def chunked(items):
+    """Splits items into lists of at most MAX_BATCH_SIZE, the most one batch request may carry."""
+    return [items[start:start + MAX_BATCH_SIZE] for start in range(0, len(items), MAX_BATCH_SIZE)]
+
+
+def batch_login(server_name, server_address, credentials):
+    """Logs in every credential with one /login/batch round trip per MAX_BATCH_SIZE credentials."""
+    global auth_success_count
+    for chunk in chunked(credentials):
+        try:
+            response = server_request(server_name, server_address, 'POST', '/login/batch', json={'credentials': chunk})
+            results = response.json().get('results', [])
+        except requests.exceptions.RequestException as e:
+            log_message("ERROR: %s: Batch authentication failed: %s", server_name, e)
+            continue
+        for creds, result in zip(chunk, results):
+            username = creds['username']
+            if 'token' in result:
+                tokens.put(server_name + username, result['token'], result.get('expires_in'))
+                with counter_lock:
+                    auth_success_count += 1
+                log_message("SUCCESS: Authenticated %s with %s.", username, server_name)
+            else:
+                log_message("ERROR: %s: Authentication failed for %s: %s", server_name, username, result.get('error'))
+
+
+def batch_action(server_name, server_address, user_tokens):
+    """Performs an action for every (username, token) pair with one /actions/batch round trip per MAX_BATCH_SIZE pairs."""
+    global actions_performed_count
+    for chunk in chunked(user_tokens):
+        try:
+            response = server_request(server_name, server_address, 'POST', '/actions/batch',
+                                      json={'tokens': [token for _, token in chunk]})
+            results = response.json().get('results', [])
+        except requests.exceptions.RequestException as e:
+            log_message("ERROR: %s: Batch action failed: %s", server_name, e)
+            continue
+        for (username, token), result in zip(chunk, results):
+            if 'message' in result:
+                if 'expires_in' in result:
+                    tokens.put(server_name + username, token, result['expires_in'])
+                with counter_lock:
+                    actions_performed_count += 1
+                log_message("SUCCESS: Performed action on %s as %s.", server_name, username)
+            else:
+                tokens.invalidate(server_name + username)  # Log in again on the next cycle
+                log_message("ERROR: %s: Action failed for %s: %s", server_name, username, result.get('error'))
+
+
+def refresh_token(server_name, server_address, username, token):
+    """Exchanges a token that is about to expire for a new one. Returns the new token, or None."""
+    try:
+        response = server_request(server_name, server_address, 'POST', '/refresh', headers={'Authorization': f'Bearer {token}'})
+        body = response.json()
     except requests.exceptions.RequestException as e:
-        log_message(f"ERROR: {server_name}: Action failed for {username}: {e}")
+        log_message("ERROR: %s: Token refresh failed for %s: %s", server_name, username, e)
+        return None
+    tokens.put(server_name + username, body.get('token'), body.get('expires_in'))
+    log_message("SUCCESS: Refreshed token for %s with %s.", username, server_name)
+    return body.get('token')
+
+
+def get_token(server_name, server_address, username, password):
+    """Returns a cached token, refreshing it when it is about to expire and logging in only as a last resort."""
+    token = tokens.get(server_name + username)
+    if token is None:
+        expiring = tokens.get_refreshable(server_name + username)
+        if expiring is not None:
+            token = refresh_token(server_name, server_address, username, expiring)
+    if token is None:
+        token = authenticate(server_name, server_address, username, password)
+    return token
 
 
 def simulate_client_activity():
     while True:
         for server_name, server_address in SERVERS.items():
             for creds in CLIENT_CREDENTIALS:
-                token = authenticate(server_name, server_address, creds['username'], creds['password'])
+                token = get_token(server_name, server_address, creds['username'], creds['password'])
                 if token:
                     perform_action(server_name, server_address, creds['username'], token)
                 time.sleep(1)
 
 
-class ClientGUI:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("Client Application Dashboard")
+def run_client_pair(server_name, server_address, creds, interval):
+    token = get_token(server_name, server_address, creds['username'], creds['password'])
+    if token:
+        perform_action(server_name, server_address, creds['username'], token)
+    time.sleep(interval)
+    return server_name, server_address, creds
 
-        try:
-            self.original_image = Image.open(CLIENT_LOGO)
-            screen_width = root.winfo_screenwidth()
-            screen_height = root.winfo_screenheight()
-            image_width, image_height = self.original_image.size
-
-            if image_width > screen_width or image_height > screen_height:
-                if image_width / screen_width > image_height / screen_height:
-                    new_width = screen_width
-                    new_height = int(image_height * (screen_width / image_width))
-                else:
-                    new_height = screen_height
-                    new_width = int(image_width * (screen_height / image_height))
-            else:
-                new_width, new_height = image_width, image_height
 
-            self.resized_image = self.original_image.resize((new_width, new_height), Image.LANCZOS)
-            self.photo = ImageTk.PhotoImage(self.resized_image)
-            self.image_label = tk.Label(root, image=self.photo)
-            self.image_label.pack()
-        except FileNotFoundError:
-            logger.error(f"Image file not found: {CLIENT_LOGO}")
+def simulate_client_activity_concurrent(workers, interval):
+    """Runs login and action for every server/credential pair in parallel.
 
+    Each pair is resubmitted as soon as its previous cycle finishes, so a slow
+    or dead building only delays its own pairs instead of the whole round.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(run_client_pair, server_name, server_address, creds, interval)
+            for server_name, server_address in SERVERS.items()
+            for creds in CLIENT_CREDENTIALS
+        }
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.add(executor.submit(run_client_pair, *future.result(), interval))
 
-        self.auth_label = tk.Label(root, text="Successful Authentications: 0", font=("Helvetica", 14))
-        self.auth_label.pack()
 
-        self.action_label = tk.Label(root, text="Actions Performed: 0", font=("Helvetica", 14))
-        self.action_label.pack()
+def simulate_client_activity_batched(interval):
+    """Coalesces each server's logins and actions into one batch request each per cycle."""
+    while True:
+        for server_name, server_address in SERVERS.items():
+            missing = [creds for creds in CLIENT_CREDENTIALS if tokens.get(server_name + creds['username']) is None]
+            if missing:
+                batch_login(server_name, server_address, missing)
+            user_tokens = [(creds['username'], tokens.get(server_name + creds['username'])) for creds in CLIENT_CREDENTIALS]
+            user_tokens = [(username, token) for username, token in user_tokens if token]
+            if user_tokens:
+                batch_action(server_name, server_address, user_tokens)
+        time.sleep(interval)
 
-        self.log_text = tk.Text(root, height=10, state='disabled', wrap=tk.WORD)
-        self.log_text.pack(fill=tk.BOTH, expand=True)
 
-        self.update_gui()
+def simulate_client_activity_scheduled():
+    """Runs cycles against every server at the scheduler's rate, rotating through the credentials."""
+    credentials = {server_name: itertools.cycle(CLIENT_CREDENTIALS) for server_name in SERVERS}
 
-    def update_gui(self):
-        while not log_queue.empty():
-            message = log_queue.get()
-            self.log_message(message)
+    def make_cycle(server_name, server_address):
+        return functools.partial(run_client_pair, server_name, server_address, next(credentials[server_name]), 0)
 
-        self.auth_label.config(text=f"Successful Authentications: {auth_success_count}")
-        self.action_label.config(text=f"Actions Performed: {actions_performed_count}")
-        self.root.after(1000, self.update_gui)
+    scheduler.run(SERVERS, make_cycle)
 
-    def log_message(self, message):
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state='disabled')
+
+def client_stats():
+    stats = {"Successful Authentications": auth_success_count, "Actions Performed": actions_performed_count}
+    if scheduler is not None:
+        stats["Open Circuits"] = scheduler.open_circuits()
+        stats["Skipped Slots"] = scheduler.skipped
+    return stats
 
 
 def main():
-    client_thread = threading.Thread(target=simulate_client_activity, daemon=True)
+    global session_pool_size, scheduler
+    parser = argparse.ArgumentParser(description="Hack the City HTTP client")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Number of concurrent workers (0 runs the serial loop)")
+    parser.add_argument('--batch', action='store_true',
+                        help="Coalesce each server's logins and actions into batch requests")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="Seconds each worker waits between login/action cycles")
+    parser.add_argument('--rate', type=float,
+                        help="Target login/action cycles per second per server, with a circuit breaker per server")
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help="Fraction by which --rate spacing varies at random")
+    parser.add_argument('--aggregate-logs', type=float, metavar='SECONDS',
+                        help="Log per-interval counters instead of one line per request")
+    parser.add_argument('--headless', action='store_true',
+                        help="Run in the foreground without the Tk dashboard")
+    args = parser.parse_args()
+
+    if args.aggregate_logs:
+        log_pipeline.set_aggregation(args.aggregate_logs)
+
+    if args.rate:
+        workers = args.workers or 10
+        session_pool_size = workers
+        scheduler = RateScheduler(args.rate, args.jitter, workers)
+        client_thread = threading.Thread(target=simulate_client_activity_scheduled, daemon=True)
+    elif args.batch:
+        client_thread = threading.Thread(target=simulate_client_activity_batched, args=(args.interval,), daemon=True)
+    elif args.workers > 0:
+        session_pool_size = args.workers
+        client_thread = threading.Thread(target=simulate_client_activity_concurrent,
+                                         args=(args.workers, args.interval), daemon=True)
+    else:
+        client_thread = threading.Thread(target=simulate_client_activity, daemon=True)
+
+    if args.headless:
+        client_thread.run()  # Run the client loop in the foreground
+        return
+
+    # Deferred so headless runs never import tkinter or PIL
+    import tkinter as tk
+    from dashboard import ClientGUI
+
+    log_pipeline.add_queue_handler(log_queue, logger.name)
     client_thread.start()
 
     root = tk.Tk()
-    gui = ClientGUI(root)
+    gui = ClientGUI(root, CLIENT_LOGO, log_queue, client_stats)
     root.mainloop()
 
 if __name__ == '__main__':
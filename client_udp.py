@@ -3,20 +3,22 @@ import threading
 import queue
 import socket
 import time
-import tkinter as tk
-from PIL import Image, ImageTk
 import json
 import logging
 import uuid
+import argparse
+import random
+from token_cache import TokenCache
+import log_pipeline
+import udp_wire
+import itertools
+import functools
+from scheduler import RateScheduler
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-# Configure logging
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Configure logging (records are formatted and written off the client threads)
+log_pipeline.setup_logging()
 logger = logging.getLogger(__name__)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
 # Configuration and credential file paths
 SERVER_CONFIG_FILE = "client_config.json"
@@ -47,169 +49,422 @@ except json.JSONDecodeError:
     exit(1)
 
 # Global variables
-tokens = {}
+tokens = TokenCache()  # server_name + username -> token, reused until it nears expiry
 auth_success_count = 0
 actions_performed_count = 0
 log_queue = queue.Queue()
 udp_port = 5005  # Port for UDP communication
-broadcast_address = '255.255.255.255' # Broadcast address
+broadcast_address = '255.255.255.255' # Broadcast address, only used for discovery
+ADDRESS_CACHE_TTL = 300  # Seconds a learned server address is trusted
+MAX_BATCH_BYTES = 1400  # Keep batch datagrams within a typical Ethernet MTU
+BATCH_OVERHEAD = 200  # Bytes reserved for the batch envelope
+RETRY_INITIAL_INTERVAL = 0.05  # Seconds before the first retransmission; doubles on each retry
+RETRY_MAX_INTERVAL = 1.0
 
 # UDP Socket
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 client_socket.bind(('', udp_port))  # Bind to the specified port for receiving responses
-client_socket.settimeout(0.5)
 
-def log_message(message):
-    log_queue.put(message)
+# In-flight requests: request_id -> (server_name, Future for the response)
+pending_requests = {}
+pending_lock = threading.Lock()
+counter_lock = threading.Lock()
+
+# Wire format: JSON, or compact binary frames for servers that advertise support for them
+wire_binary = False
+server_wire_binary = {}  # server_name -> True once a JSON reply advertised binary frames
+
+# Unicast addresses: server_name -> ((ip, port), expiry time or None for static entries)
+server_addresses = {}
+address_lock = threading.Lock()
+
+# Rate-targeted scheduling with a circuit breaker per server, set by main() for --rate
+scheduler = None
+
+def log_message(message, *args):
+    logger.info(message, *args)  # Also reaches the dashboard through log_queue when it runs
+
+def receive_responses():
+    """Single receiver: routes every reply to the future waiting on its request_id."""
+    while True:
+        try:
+            data, addr = client_socket.recvfrom(65535)
+            response, binary = udp_wire.loads(data)
+        except ValueError:
+            logger.warning("Received malformed datagram.")
+            continue
+        except OSError as e:
+            logger.error(f"Receive failed: {e}")
+            continue
+
+        if not isinstance(response, dict) or 'type' in response:
+            continue  # Requests (including our own broadcasts) are not replies
+
+        try:
+            route_response(response, binary, addr)
+        except Exception:
+            logger.exception("Failed to handle reply from %s:%s.", addr[0], addr[1])  # Keep receiving
+
+def route_response(response, binary, addr):
+    """Completes the future waiting on the reply's request_id, if it came from the right server."""
+    request_id = response.get('request_id')
+    if not isinstance(request_id, str):
+        return  # Anyone on the LAN can send to this port; unhashable ids must not reach the dict
+    with pending_lock:
+        waiter = pending_requests.get(request_id)
+    if waiter is not None:
+        server_name, future = waiter
+        if binary:
+            from_server = response['building_id'] == udp_wire.building_id(server_name)
+        else:
+            from_server = response.get('server_name') == server_name
+        if from_server and not future.done():
+            learn_server_address(server_name, addr)
+            if not binary and response.get('wire') == udp_wire.VERSION:
+                server_wire_binary[server_name] = True  # Later requests can use binary frames
+            future.set_result(response)
+
+def load_static_addresses():
+    """Takes server hosts from client_config.json instead of learning them from replies."""
+    for server_name, server_address in SERVERS.items():
+        host = server_address.rsplit(':', 1)[0]
+        try:
+            ip = socket.gethostbyname(host)
+        except OSError:
+            logger.warning("Could not resolve %s for %s, using discovery instead.", host, server_name)
+            continue
+        with address_lock:
+            server_addresses[server_name] = ((ip, udp_port), None)
+
+def learn_server_address(server_name, addr):
+    with address_lock:
+        cached = server_addresses.get(server_name)
+        if cached is None or cached[1] is not None:
+            server_addresses[server_name] = (addr, time.time() + ADDRESS_CACHE_TTL)
+
+def forget_server_address(server_name):
+    with address_lock:
+        cached = server_addresses.get(server_name)
+        if cached is not None and cached[1] is not None:
+            del server_addresses[server_name]
+
+def resolve_server_address(server_name):
+    """Returns the cached unicast address for server_name, or the broadcast address."""
+    with address_lock:
+        cached = server_addresses.get(server_name)
+    if cached is not None and (cached[1] is None or cached[1] > time.time()):
+        return cached[0]
+    return (broadcast_address, udp_port)
+
+def send_request(request, timeout=5):
+    """Sends request and waits for its reply. Returns None on timeout.
+
+    Unanswered requests are retransmitted with exponential backoff and jitter
+    until timeout. Retransmissions keep the request_id, so the server answers
+    them from its reply cache instead of running them again.
+    """
+    server_name = request['server_name']
+    binary = wire_binary and server_wire_binary.get(server_name, False)
+    payload = udp_wire.dumps(request, binary)
+    future = Future()
+    with pending_lock:
+        pending_requests[request['request_id']] = (server_name, future)
+    deadline = time.monotonic() + timeout
+    interval = RETRY_INITIAL_INTERVAL
+    try:
+        while True:
+            client_socket.sendto(payload, resolve_server_address(server_name))
+            # Jitter keeps clients that lost packets together from retrying in lockstep
+            wait = min(interval * random.uniform(0.5, 1.5), deadline - time.monotonic())
+            try:
+                response = future.result(timeout=max(wait, 0))
+                if scheduler is not None:
+                    scheduler.breaker(server_name).record_success()
+                return response
+            except FutureTimeoutError:
+                if time.monotonic() >= deadline:
+                    raise
+            interval = min(interval * 2, RETRY_MAX_INTERVAL)
+    except FutureTimeoutError:
+        forget_server_address(server_name)  # Rediscover by broadcast next time
+        if binary:
+            # The server may have been replaced: renegotiate from JSON on the next request
+            logger.warning("No reply to binary request from %s, using JSON until it advertises binary again.", server_name)
+            server_wire_binary.pop(server_name, None)
+        if scheduler is not None:
+            scheduler.breaker(server_name).record_failure()
+        return None
+    finally:
+        with pending_lock:
+            pending_requests.pop(request['request_id'], None)
 
 def authenticate(server_name, server_address, username, password):
-    global auth_success_count
-    request_id = str(uuid.uuid4())
     request = {
         'type': 'login',
         'username': username,
         'password': password,
         'client_id': CLIENT_UUID,
-        'request_id': request_id,
+        'request_id': str(uuid.uuid4()),
         'server_name': server_name
     }
     try:
-        client_socket.sendto(json.dumps(request).encode(), (broadcast_address, udp_port))
-        start_time = time.time()
-        while time.time() - start_time < 5:
-            try:
-                data, addr = client_socket.recvfrom(1024)
-                response = json.loads(data.decode())
-                if response.get('request_id') == request_id and response.get('server_name') == server_name:
-                    if 'token' in response:
-                        token = response['token']
-                        tokens[server_name + username] = token
-                        auth_success_count += 1
-                        log_message(f"SUCCESS: Authenticated {username} with {server_name}.")
-                        return token
-                    elif 'error' in response:
-                        log_message(f"ERROR: {server_name}: Authentication failed for {username}: {response['error']}")
-                        return None
-            except socket.timeout:
-                continue
-            except json.JSONDecodeError:
-                logger.warning("Received non-JSON data or malformed JSON data.")
-                continue
-        log_message(f"ERROR: {server_name}: Authentication timeout for {username}.")
-        return None
+        response = send_request(request)
     except OSError as e:
-        log_message(f"ERROR: {server_name}: Authentication failed for {username}, Socket Error : {e}")
+        log_message("ERROR: %s: Authentication failed for %s, Socket Error : %s", server_name, username, e)
         return None
 
+    return handle_login_response(server_name, username, response)
+
+def handle_login_response(server_name, username, response):
+    """Records the outcome of a login reply and returns the token, if any."""
+    global auth_success_count
+    if response is None:
+        log_message("ERROR: %s: Authentication timeout for %s.", server_name, username)
+        return None
+    if 'token' in response:
+        token = response['token']
+        tokens.put(server_name + username, token, response.get('expires_in'))
+        with counter_lock:
+            auth_success_count += 1
+        log_message("SUCCESS: Authenticated %s with %s.", username, server_name)
+        return token
+    log_message("ERROR: %s: Authentication failed for %s: %s", server_name, username, response.get('error'))
+    return None
+
 
 
 def perform_action(server_name, username, token):
-    global actions_performed_count
-    request_id = str(uuid.uuid4())
     request = {
         'type': 'action',
         'token': token,
         'client_id': CLIENT_UUID,
-        'request_id': request_id,
+        'request_id': str(uuid.uuid4()),
         'server_name': server_name
     }
     try:
-        client_socket.sendto(json.dumps(request).encode(), (broadcast_address, udp_port))
-        start_time = time.time()
-        while time.time() - start_time < 5:
-            try:
-                data, addr = client_socket.recvfrom(1024)
-                response = json.loads(data.decode())
-                if response.get('request_id') == request_id and response.get('server_name') == server_name:
-                    if 'message' in response:
-                        actions_performed_count += 1
-                        log_message(f"SUCCESS: Performed action on {server_name} as {username}.")
-                        return
-                    elif 'error' in response:
-                        log_message(f"ERROR: {server_name}: Action failed for {username}: {response['error']}")
-                        return
-            except socket.timeout:
-                continue
-            except json.JSONDecodeError:
-                logger.warning("Received non-JSON data or malformed JSON data.")
-                continue
-        log_message(f"ERROR: {server_name}: Action timeout for {username}.")
+        response = send_request(request)
+    except OSError as e:
+        log_message("ERROR: %s: Action failed for %s, Socket error %s", server_name, username, e)
+        return
+
+    handle_action_response(server_name, username, token, response)
+
+def handle_action_response(server_name, username, token, response):
+    global actions_performed_count
+    if response is None:
+        log_message("ERROR: %s: Action timeout for %s.", server_name, username)
+    elif 'message' in response:
+        if 'expires_in' in response:
+            tokens.put(server_name + username, token, response['expires_in'])  # Sliding expiry: the session was extended
+        with counter_lock:
+            actions_performed_count += 1
+        log_message("SUCCESS: Performed action on %s as %s.", server_name, username)
+    else:
+        tokens.invalidate(server_name + username)  # Rejected token: log in again on the next cycle
+        log_message("ERROR: %s: Action failed for %s: %s", server_name, username, response.get('error'))
+
+def send_batch(server_name, requests):
+    """Sends requests to server_name coalesced into as few MTU-sized batch datagrams as possible.
+
+    Returns one response per request, in order; None where a batch timed out.
+    """
+    binary = wire_binary and server_wire_binary.get(server_name, False)
+    chunks = [[]]
+    chunk_size = BATCH_OVERHEAD
+    for request in requests:
+        size = len(udp_wire.dumps(request, binary)) + 4
+        if chunks[-1] and chunk_size + size > MAX_BATCH_BYTES:
+            chunks.append([])
+            chunk_size = BATCH_OVERHEAD
+        chunks[-1].append(request)
+        chunk_size += size
+
+    responses = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        batch = {
+            'type': 'batch',
+            'requests': chunk,
+            'client_id': CLIENT_UUID,
+            'request_id': str(uuid.uuid4()),
+            'server_name': server_name
+        }
+        reply = send_request(batch)
+        if reply is not None and len(reply.get('responses') or []) == len(chunk):
+            responses.extend(reply['responses'])
+        else:
+            responses.extend([None] * len(chunk))
+    return responses
+
+def batch_login(server_name, credentials):
+    """Logs in every credential with one batch round trip per datagram."""
+    requests = [{
+        'type': 'login',
+        'username': creds['username'],
+        'password': creds['password'],
+        'client_id': CLIENT_UUID,
+        'request_id': str(uuid.uuid4())
+    } for creds in credentials]
+    try:
+        responses = send_batch(server_name, requests)
+    except OSError as e:
+        log_message("ERROR: %s: Batch authentication failed, Socket Error : %s", server_name, e)
+        return
+    for creds, response in zip(credentials, responses):
+        handle_login_response(server_name, creds['username'], response)
+
+def batch_action(server_name, user_tokens):
+    """Performs an action for every (username, token) pair with one batch round trip per datagram."""
+    requests = [{
+        'type': 'action',
+        'token': token,
+        'client_id': CLIENT_UUID,
+        'request_id': str(uuid.uuid4())
+    } for username, token in user_tokens]
+    try:
+        responses = send_batch(server_name, requests)
+    except OSError as e:
+        log_message("ERROR: %s: Batch action failed, Socket error %s", server_name, e)
+        return
+    for (username, token), response in zip(user_tokens, responses):
+        handle_action_response(server_name, username, token, response)
+
+def refresh_token(server_name, username, token):
+    """Exchanges a token that is about to expire for a new one. Returns the new token, or None."""
+    request = {
+        'type': 'refresh',
+        'token': token,
+        'client_id': CLIENT_UUID,
+        'request_id': str(uuid.uuid4()),
+        'server_name': server_name
+    }
+    try:
+        response = send_request(request)
     except OSError as e:
-        log_message(f"ERROR: {server_name}: Action failed for {username}, Socket error {e}")
+        log_message("ERROR: %s: Token refresh failed for %s, Socket error %s", server_name, username, e)
+        return None
+    if response is None or 'token' not in response:
+        log_message("ERROR: %s: Token refresh failed for %s: %s", server_name, username,
+                    'timeout' if response is None else response.get('error'))
+        return None
+    tokens.put(server_name + username, response['token'], response.get('expires_in'))
+    log_message("SUCCESS: Refreshed token for %s with %s.", username, server_name)
+    return response['token']
+
+def get_token(server_name, server_address, username, password):
+    """Returns a cached token, refreshing it when it is about to expire and logging in only as a last resort."""
+    token = tokens.get(server_name + username)
+    if token is None:
+        expiring = tokens.get_refreshable(server_name + username)
+        if expiring is not None:
+            token = refresh_token(server_name, username, expiring)
+    if token is None:
+        token = authenticate(server_name, server_address, username, password)
+    return token
 
 
 
 def simulate_client_activity():
     for server_name, server_address in SERVERS.items():
         for creds in CLIENT_CREDENTIALS:
-            token = authenticate(server_name, server_address, creds['username'], creds['password'])
+            token = get_token(server_name, server_address, creds['username'], creds['password'])
             if token:
                 perform_action(server_name, creds['username'], token)
             time.sleep(1)
 
-class ClientGUI:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("Client Application Dashboard")
+def run_client_pair(server_name, server_address, creds):
+    token = get_token(server_name, server_address, creds['username'], creds['password'])
+    if token:
+        perform_action(server_name, creds['username'], token)
 
-        try:
-            self.original_image = Image.open(CLIENT_LOGO)
-            screen_width = root.winfo_screenwidth()
-            screen_height = root.winfo_screenheight()
-            image_width, image_height = self.original_image.size
+def simulate_client_activity_concurrent(workers):
+    """Keeps logins and actions for every server/credential pair in flight at once."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for server_name, server_address in SERVERS.items():
+            for creds in CLIENT_CREDENTIALS:
+                executor.submit(run_client_pair, server_name, server_address, creds)
+
+def simulate_client_activity_batched():
+    """One pass over the servers, coalescing each server's logins and actions into batches."""
+    for server_name, server_address in SERVERS.items():
+        batch_login(server_name, [creds for creds in CLIENT_CREDENTIALS
+                                  if tokens.get(server_name + creds['username']) is None])
+        user_tokens = [(creds['username'], tokens.get(server_name + creds['username'])) for creds in CLIENT_CREDENTIALS]
+        batch_action(server_name, [(username, token) for username, token in user_tokens if token])
+
+def simulate_client_activity_scheduled():
+    """Runs cycles against every server at the scheduler's rate, rotating through the credentials."""
+    credentials = {server_name: itertools.cycle(CLIENT_CREDENTIALS) for server_name in SERVERS}
 
-            if image_width > screen_width or image_height > screen_height:
-                if image_width / screen_width > image_height / screen_height:
-                    new_width = screen_width
-                    new_height = int(image_height * (screen_width / image_width))
-                else:
-                    new_height = screen_height
-                    new_width = int(image_width * (screen_height / image_height))
-            else:
-                new_width, new_height = image_width, image_height
+    def make_cycle(server_name, server_address):
+        return functools.partial(run_client_pair, server_name, server_address, next(credentials[server_name]))
 
-            self.resized_image = self.original_image.resize((new_width, new_height), Image.LANCZOS)
-            self.photo = ImageTk.PhotoImage(self.resized_image)
-            self.image_label = tk.Label(root, image=self.photo)
-            self.image_label.pack()
-        except FileNotFoundError:
-            logger.error(f"Image file not found: {CLIENT_LOGO}")
+    scheduler.run(SERVERS, make_cycle)
 
-        self.auth_label = tk.Label(root, text="Successful Authentications: 0", font=("Helvetica", 14))
-        self.auth_label.pack()
+def client_stats():
+    stats = {"Successful Authentications": auth_success_count, "Actions Performed": actions_performed_count}
+    if scheduler is not None:
+        stats["Open Circuits"] = scheduler.open_circuits()
+        stats["Skipped Slots"] = scheduler.skipped
+    return stats
 
-        self.action_label = tk.Label(root, text="Actions Performed: 0", font=("Helvetica", 14))
-        self.action_label.pack()
 
-        self.log_text = tk.Text(root, height=10, state='disabled', wrap=tk.WORD)
-        self.log_text.pack(fill=tk.BOTH, expand=True)
+def main():
+    global wire_binary, scheduler
+    parser = argparse.ArgumentParser(description="Hack the City UDP client")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Number of concurrent workers (0 runs the serial pass)")
+    parser.add_argument('--config-addresses', action='store_true',
+                        help="Send to the hosts in client_config.json instead of discovering them by broadcast")
+    parser.add_argument('--batch', action='store_true',
+                        help="Coalesce each server's logins and actions into batch datagrams")
+    parser.add_argument('--wire', choices=['json', 'binary'], default='json',
+                        help="Wire format; binary is used per server once its JSON replies advertise support")
+    parser.add_argument('--rate', type=float,
+                        help="Target login/action cycles per second per server, with a circuit breaker per server")
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help="Fraction by which --rate spacing varies at random")
+    parser.add_argument('--aggregate-logs', type=float, metavar='SECONDS',
+                        help="Log per-interval counters instead of one line per request")
+    parser.add_argument('--headless', action='store_true',
+                        help="Run in the foreground without the Tk dashboard")
+    args = parser.parse_args()
 
-        self.update_gui()
+    if args.aggregate_logs:
+        log_pipeline.set_aggregation(args.aggregate_logs)
 
-    def update_gui(self):
-        while not log_queue.empty():
-            message = log_queue.get()
-            self.log_message(message)
+    wire_binary = args.wire == 'binary'
+    if args.config_addresses:
+        load_static_addresses()
 
-        self.auth_label.config(text=f"Successful Authentications: {auth_success_count}")
-        self.action_label.config(text=f"Actions Performed: {actions_performed_count}")
-        self.root.after(1000, self.update_gui)
+    receiver_thread = threading.Thread(target=receive_responses, daemon=True)
+    receiver_thread.start()
 
-    def log_message(self, message):
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state='disabled')
+    if args.rate:
+        scheduler = RateScheduler(args.rate, args.jitter, args.workers or 10)
+        client_thread = threading.Thread(target=simulate_client_activity_scheduled, daemon=True)
+    elif args.batch:
+        client_thread = threading.Thread(target=simulate_client_activity_batched, daemon=True)
+    elif args.workers > 0:
+        client_thread = threading.Thread(target=simulate_client_activity_concurrent, args=(args.workers,), daemon=True)
+    else:
+        client_thread = threading.Thread(target=simulate_client_activity, daemon=True)
 
+    if args.headless:
+        client_thread.run()  # Run the client loop in the foreground
+        return
 
+    # Deferred so headless runs never import tkinter or PIL
+    import tkinter as tk
+    from dashboard import ClientGUI
 
-def main():
-    client_thread = threading.Thread(target=simulate_client_activity, daemon=True)
+    log_pipeline.add_queue_handler(log_queue, logger.name)
     client_thread.start()
 
     root = tk.Tk()
-    gui = ClientGUI(root)
+    gui = ClientGUI(root, CLIENT_LOGO, log_queue, client_stats)
     root.mainloop()
 
 if __name__ == '__main__':
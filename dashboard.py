@@ -0,0 +1,192 @@
+"""Tk dashboards shared by the servers and clients.
+
+Imported lazily by each entry point so that --headless runs never load
+tkinter or PIL.
+"""
+import hashlib
+import logging
+import os
+import queue
+import tkinter as tk
+from PIL import Image, ImageTk
+
+logger = logging.getLogger(__name__)
+
+
+LOGO_CACHE_DIR = ".logo_cache"  # Pre-scaled logos, keyed by source file, mtime and target size
+MAX_LOG_LINES = 1000  # Lines kept in the log view; older lines are dropped
+MAX_MESSAGES_PER_TICK = 200  # Queued messages shown per update
+MAX_SUPPRESSED_PER_TICK = 50000  # Backlog discarded per update once the view falls behind
+
+
+def fit_to_screen(image_width, image_height, screen_width, screen_height):
+    """Returns the largest size with the image's aspect ratio that fits on screen."""
+    if image_width > screen_width or image_height > screen_height:
+        if image_width / screen_width > image_height / screen_height:
+            # Width is the limiting factor
+            return screen_width, int(image_height * (screen_width / image_width))
+        # Height is the limiting factor
+        return int(image_width * (screen_height / image_height)), screen_height
+    return image_width, image_height  # No resize needed
+
+
+def logo_cache_path(path, size):
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{size[0]}x{size[1]}"
+    return os.path.join(LOGO_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".png")
+
+
+def load_scaled_image(path, screen_width, screen_height):
+    """Opens path scaled to fit the screen, reusing a cached copy from an earlier launch."""
+    original_image = Image.open(path)  # Only reads the header
+    size = fit_to_screen(*original_image.size, screen_width, screen_height)
+    if size == original_image.size:
+        return original_image
+
+    cache_path = logo_cache_path(path, size)
+    try:
+        return Image.open(cache_path)
+    except (OSError, ValueError):
+        pass  # Not cached yet (or unreadable): scale it now
+
+    # Let the JPEG decoder downscale by a power of two before resampling
+    original_image.draft('RGB', size)
+    resized_image = original_image.resize(size, Image.LANCZOS)  # High-quality resize
+    try:
+        os.makedirs(LOGO_CACHE_DIR, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        resized_image.save(temp_path, format="PNG")
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"Could not cache scaled logo {path}: {e}")
+    return resized_image
+
+
+def load_logo(root, path):
+    """Loads the logo at path, scaled down to fit the screen. Returns None if it is missing."""
+    try:
+        image = load_scaled_image(path, root.winfo_screenwidth(), root.winfo_screenheight())
+    except FileNotFoundError:
+        logger.error(f"Image file not found: {path}")
+        return None
+    return ImageTk.PhotoImage(image)
+
+
+class Dashboard:
+    """Logo, a label per statistic and a log view, refreshed once a second.
+
+    stats is a callable returning {label: value}. Each tick shows at most
+    MAX_MESSAGES_PER_TICK messages from message_queue in one batched insert;
+    any further backlog is discarded and summarised as "N messages
+    suppressed". The log view keeps only the last MAX_LOG_LINES lines.
+    """
+
+    def __init__(self, root, title, logo_path, message_queue, stats, wrap=tk.NONE):
+        self.root = root
+        self.root.title(title)
+        self.message_queue = message_queue
+        self.stats = stats
+
+        self.photo = load_logo(root, logo_path)
+        if self.photo is not None:
+            self.image_label = tk.Label(root, image=self.photo)
+            self.image_label.pack()
+
+        self.stat_labels = {}
+        for name, value in stats().items():
+            label = tk.Label(root, text=f"{name}: {value}", font=("Helvetica", 14))
+            label.pack()
+            self.stat_labels[name] = label
+
+        self.log_text = tk.Text(root, height=10, state='disabled', wrap=wrap)
+        self.log_text.pack(fill=tk.BOTH, expand=True)
+
+    def update_gui(self):
+        lines = self.drain_queue()
+        if lines:
+            self.append_lines(lines)
+
+        for name, value in self.stats().items():
+            self.stat_labels[name].config(text=f"{name}: {value}")
+        self.root.after(1000, self.update_gui)  # Update every 1000ms (1 second)
+
+    def drain_queue(self):
+        """Returns the log lines for this tick, collapsing any overflow into a summary line."""
+        lines = []
+        for _ in range(MAX_MESSAGES_PER_TICK):
+            try:
+                message = self.message_queue.get_nowait()
+            except queue.Empty:
+                return lines
+            line = self.handle_message(message)
+            if line is not None:
+                lines.append(line)
+
+        suppressed = 0
+        for _ in range(MAX_SUPPRESSED_PER_TICK):
+            try:
+                self.message_queue.get_nowait()
+            except queue.Empty:
+                break
+            suppressed += 1
+        if suppressed:
+            lines.append(f"{suppressed} messages suppressed")
+        return lines
+
+    def handle_message(self, message):
+        """Returns the log line for a queued message, or None if it is not logged."""
+        return message
+
+    def log_message(self, message):
+        self.append_lines([message])
+
+    def append_lines(self, lines):
+        self.log_text.config(state='normal')
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        # The Text widget always ends with an empty line after the last newline
+        line_count = int(self.log_text.index('end-1c').split('.')[0]) - 1
+        if line_count > MAX_LOG_LINES:
+            self.log_text.delete('1.0', f'{line_count - MAX_LOG_LINES + 1}.0')
+        self.log_text.see(tk.END)
+        self.log_text.config(state='disabled')
+
+
+class ServerGUI(Dashboard):
+    """Server dashboard: gui_queue carries {"type": "log"|"error", "content": ...} messages."""
+
+    def __init__(self, root, building_name, building_logo, gui_queue, stats):
+        super().__init__(root, f"{building_name} Server Dashboard", building_logo, gui_queue, stats)
+        if self.photo is None:
+            gui_queue.put({"type": "error", "content": f"Image file not found: {building_logo}"})
+
+        self.error_label = tk.Label(root, text="", fg="red")  # For displaying errors
+        self.error_label.pack()
+        self.error_clear_job = None
+
+        self.update_gui()
+
+    def handle_message(self, message):
+        if message["type"] == "log":
+            return message["content"]
+        if message["type"] == "error":
+            self.show_error(message["content"])
+        return None
+
+    def show_error(self, message):
+        self.error_label.config(text=message)
+        # Restart the timer instead of piling up one callback per error
+        if self.error_clear_job is not None:
+            self.root.after_cancel(self.error_clear_job)
+        self.error_clear_job = self.root.after(5000, self.clear_error)  # Clear error after 5 seconds
+
+    def clear_error(self):
+        self.error_clear_job = None
+        self.error_label.config(text="")
+
+
+class ClientGUI(Dashboard):
+    """Client dashboard: log_queue carries plain log lines."""
+
+    def __init__(self, root, logo_path, log_queue, stats):
+        super().__init__(root, "Client Application Dashboard", logo_path, log_queue, stats, wrap=tk.WORD)
+        self.update_gui()
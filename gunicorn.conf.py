@@ -0,0 +1,26 @@
+# Production serving for server.py: gunicorn -c gunicorn.conf.py server:app
+# Workers only share tokens through a shared store, so one worker is started
+# unless every building uses "token_mode" "sqlite", or "hmac" with a token_secret.
+import json
+import multiprocessing
+from buildings import load_configs, sessions_shared
+
+# Not named "config": gunicorn would read that as its own config-file setting
+with open("server_config.json", "r") as _f:
+    _server_config = json.load(_f)
+
+bind = f"0.0.0.0:{_server_config.get('port', 80)}"
+if sessions_shared(load_configs(_server_config)):
+    workers = multiprocessing.cpu_count()
+else:
+    print("gunicorn.conf.py: in-memory tokens are per process, starting 1 worker "
+          "(use token_mode 'sqlite', or 'hmac' with a token_secret, for more)")
+    workers = 1
+
+
+def post_worker_init(worker):
+    # server.main() never runs under gunicorn, so start its token sweeper and snapshots here;
+    # the final snapshot is saved by the atexit handler they register
+    import server
+    server.start_background_threads()
+
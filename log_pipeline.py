@@ -0,0 +1,155 @@
+"""Asynchronous logging shared by the servers and clients.
+
+Request threads only put the raw LogRecord on a queue; a QueueListener
+thread formats it and writes it to the console (and the dashboard, when one
+is attached). Call sites should pass arguments lazily
+(logger.info("ACTION: %s ...", username)) so no formatting happens on the
+request thread.
+
+In aggregate mode, records below ERROR with the same logger, level, message
+template and arguments are counted and written once per interval as e.g.
+"ACTION: user1 performed an action. (x1,240 in 1s)".
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_record_queue = queue.SimpleQueue()
+_listener = None
+_dispatcher = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records without formatting them on the calling thread."""
+
+    def prepare(self, record):
+        return record
+
+
+class DispatchHandler(logging.Handler):
+    """Runs on the listener thread: forwards records to the output handlers, optionally aggregated."""
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.handlers = list(handlers)
+        self.interval = None  # Aggregation interval in seconds; None writes every record
+        self.counts = {}  # (logger, level, template, args) -> [first record, count]
+        self.flusher = None
+
+    def emit(self, record):
+        if self.interval is None or record.levelno >= logging.ERROR:
+            self.forward(record)
+            return
+        try:
+            key = (record.name, record.levelno, record.msg, record.args)
+            hash(key)
+        except TypeError:
+            self.forward(record)  # Unhashable arguments cannot be counted
+            return
+        entry = self.counts.get(key)
+        if entry is None:
+            self.counts[key] = [record, 1]
+        else:
+            entry[1] += 1
+
+    def forward(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def flush_counts(self):
+        self.acquire()
+        try:
+            counts, self.counts = self.counts, {}
+        finally:
+            self.release()
+        for record, count in counts.values():
+            if count > 1:
+                record = logging.makeLogRecord(record.__dict__)
+                record.msg = f"{record.getMessage()} (x{count:,} in {self.interval:g}s)"
+                record.args = None
+            self.forward(record)
+
+    def run_flusher(self):
+        while self.interval is not None:
+            time.sleep(self.interval)
+            self.flush_counts()
+
+
+class QueueMessageHandler(logging.Handler):
+    """Feeds formatted lines into a dashboard queue.
+
+    With message_type set, lines are wrapped as {"type": message_type, "content": line}.
+    """
+
+    def __init__(self, message_queue, message_type=None):
+        super().__init__()
+        self.message_queue = message_queue
+        self.message_type = message_type
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record):
+        line = self.format(record)
+        if self.message_type is None:
+            self.message_queue.put(line)
+        else:
+            self.message_queue.put({"type": self.message_type, "content": line})
+
+
+def setup_logging(level=logging.INFO):
+    """Routes all logging through the queue and starts the listener thread."""
+    global _listener, _dispatcher
+    if _listener is not None:
+        return
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _dispatcher = DispatchHandler([console_handler])
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [DeferredQueueHandler(_record_queue)]
+
+    _start_threads()
+    atexit.register(_stop_listener)
+    if hasattr(os, 'register_at_fork'):
+        # Threads do not survive fork (e.g. gunicorn --preload); restart them in the child
+        os.register_at_fork(after_in_child=_start_threads)
+
+
+def set_aggregation(interval):
+    """Counts repeated records and writes them once per interval seconds (None disables)."""
+    _dispatcher.flush_counts()
+    _dispatcher.interval = interval
+    if interval is not None and (_dispatcher.flusher is None or not _dispatcher.flusher.is_alive()):
+        _start_flusher()
+
+
+def add_queue_handler(message_queue, logger_name, message_type=None):
+    """Also sends records from logger_name (and its children) to a dashboard queue."""
+    handler = QueueMessageHandler(message_queue, message_type)
+    handler.addFilter(logging.Filter(logger_name))
+    _dispatcher.handlers.append(handler)
+
+
+def _start_threads():
+    global _listener
+    _listener = logging.handlers.QueueListener(_record_queue, _dispatcher)
+    _listener.start()
+    if _dispatcher.interval is not None:
+        _start_flusher()
+
+
+def _start_flusher():
+    _dispatcher.flusher = threading.Thread(target=_dispatcher.run_flusher, daemon=True)
+    _dispatcher.flusher.start()
+
+
+def _stop_listener():
+    _listener.stop()
+    _dispatcher.flush_counts()
@@ -0,0 +1,137 @@
+"""In-process counters, latency histograms and gauges, exposed as Prometheus text."""
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    """Escapes a label value as the exposition format requires."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metrics:
+    """Thread-safe metric registry.
+
+    Counters and histograms are created on first use; gauges are callables
+    sampled when the metrics are rendered.
+    """
+
+    def __init__(self, prefix='htc'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}  # name -> {label key: value}
+        self._histograms = {}  # name -> {label key: [bucket counts..., +Inf count, sum]}
+        self._gauges = {}  # name -> callable
+        self._help = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(LATENCY_BUCKETS)] += 1
+            counts[-1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, sample):
+        self._gauges[name] = sample
+
+    def value(self, name, **labels):
+        """Returns the current value of a counter (0 if never incremented)."""
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: list(counts) for key, counts in series.items()}
+                          for name, series in self._histograms.items()}
+        lines = []
+        for name, series in sorted(counters.items()):
+            full_name = f'{self.prefix}_{name}'
+            self._header(lines, name, full_name, 'counter')
+            for key, value in sorted(series.items()):
+                lines.append(f'{full_name}{_format_labels(key)} {value}')
+        for name, series in sorted(histograms.items()):
+            full_name = f'{self.prefix}_{name}'
+            self._header(lines, name, full_name, 'histogram')
+            for key, counts in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, counts):
+                    cumulative += count
+                    lines.append(f'{full_name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+                cumulative += counts[len(LATENCY_BUCKETS)]
+                lines.append(f'{full_name}_bucket{_format_labels(key, [("le", "+Inf")])} {cumulative}')
+                lines.append(f'{full_name}_sum{_format_labels(key)} {counts[-1]:.6f}')
+                lines.append(f'{full_name}_count{_format_labels(key)} {cumulative}')
+        for name, sample in sorted(self._gauges.items()):
+            full_name = f'{self.prefix}_{name}'
+            self._header(lines, name, full_name, 'gauge')
+            lines.append(f'{full_name} {sample()}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, full_name, metric_type):
+        if name in self._help:
+            lines.append(f'# HELP {full_name} {self._help[name]}')
+        lines.append(f'# TYPE {full_name} {metric_type}')
+
+
+def serve_metrics(metrics, port, host=''):
+    """Serves metrics.render() over HTTP on port from a daemon thread. Returns the server."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are not worth a log line each
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
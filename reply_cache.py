@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+
+MAX_ENTRIES = 10000
+TTL = 30  # Seconds a reply is kept; comfortably longer than a client keeps retransmitting
+
+
+class ReplyCache:
+    """Server-side cache of recent replies, keyed by (client_id, request_id).
+
+    A retransmitted request gets the reply that was sent the first time
+    instead of being processed again, so a repeated login does not mint a
+    second token. Entries expire after ttl seconds and the least recently
+    added entry is evicted beyond max_entries. Not thread-safe: each UDP
+    server engine calls it from a single thread.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self._replies = OrderedDict()  # key -> (expiry time, reply), oldest first
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def get(self, key, now=None):
+        """Returns the cached reply for key, or None."""
+        cached = self._replies.get(key)
+        if cached is None:
+            return None
+        if (time.monotonic() if now is None else now) >= cached[0]:
+            return None
+        return cached[1]
+
+    def put(self, key, reply, now=None):
+        now = time.monotonic() if now is None else now
+        self._replies[key] = (now + self.ttl, reply)
+        self._replies.move_to_end(key)
+        # Entries share one ttl, so the oldest are also the first to expire
+        while self._replies:
+            oldest_expiry, _ = next(iter(self._replies.values()))
+            if len(self._replies) <= self.max_entries and oldest_expiry > now:
+                break
+            self._replies.popitem(last=False)
+
+    def __len__(self):
+        return len(self._replies)
@@ -0,0 +1,130 @@
+"""Rate-targeted client scheduling with a circuit breaker per server, shared by both clients.
+
+RateScheduler starts one client cycle per server every 1 / rate seconds,
+jittered so clients started together do not hit the servers in lockstep.
+Start times are fixed in advance rather than taken from the end of the
+previous cycle, so slow replies do not lower the rate. Each server may have
+only a few cycles in flight; a slot that finds them all busy is skipped.
+
+A CircuitBreaker opens after a run of consecutive failures. While it is
+open, the server's slots are skipped except for one probe per backoff
+interval, which doubles after every failed probe; the first success closes
+it again. Healthy servers keep their rate while a broken one is out.
+"""
+import heapq
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BREAKER_THRESHOLD = 3  # Consecutive failures that open a breaker
+PROBE_INITIAL_INTERVAL = 1.0  # Seconds before the first probe of an open breaker; doubles after each failed probe
+PROBE_MAX_INTERVAL = 30.0
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of one server and decides when to try it again."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, probe_interval=PROBE_INITIAL_INTERVAL,
+                 max_probe_interval=PROBE_MAX_INTERVAL):
+        self._lock = threading.Lock()
+        self.threshold = threshold
+        self.initial_probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.failures = 0
+        self.open = False
+        self._probe_interval = probe_interval
+        self._next_probe = 0.0
+        self._probing = False
+
+    def allow(self, now=None):
+        """True if a request may be sent: always while closed, once per probe interval while open."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not self.open:
+                return True
+            if now < self._next_probe:
+                return False
+            self._next_probe = now + self._probe_interval  # A probe that never reports frees the slot again
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.open = False
+            self._probing = False
+            self._probe_interval = self.initial_probe_interval
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.failures += 1
+            if not self.open:
+                if self.failures >= self.threshold:
+                    self.open = True
+                    self._next_probe = now + self._probe_interval
+                return
+            if self._probing:
+                # Only a failed probe backs off further, not requests sent before the breaker opened
+                self._probing = False
+                self._probe_interval = min(self._probe_interval * 2, self.max_probe_interval)
+                self._next_probe = now + self._probe_interval
+
+
+class RateScheduler:
+    """Runs client cycles against each server at a target rate, skipping servers whose breaker is open."""
+
+    def __init__(self, rate, jitter=0.2, workers=10):
+        self.rate = rate  # Cycles per second per server
+        self.jitter = jitter  # Each gap varies by up to this fraction of 1 / rate
+        self.workers = workers
+        self.breakers = {}  # server_name -> CircuitBreaker
+        self.skipped = 0  # Slots not run because the breaker was open or the server had too many cycles in flight
+        self._in_flight = {}  # server_name -> running cycles
+        self._lock = threading.Lock()
+
+    def breaker(self, server_name):
+        with self._lock:
+            breaker = self.breakers.get(server_name)
+            if breaker is None:
+                breaker = self.breakers[server_name] = CircuitBreaker()
+            return breaker
+
+    def open_circuits(self):
+        with self._lock:
+            return sum(breaker.open for breaker in self.breakers.values())
+
+    def _gap(self):
+        return random.uniform(1 - self.jitter, 1 + self.jitter) / self.rate
+
+    def run(self, servers, make_cycle):
+        """Runs forever. make_cycle(server_name, server_address) returns the callable for the next cycle."""
+        max_in_flight = max(1, self.workers // max(1, len(servers)))
+        now = time.monotonic()
+        # Random offsets spread the servers' first slots over one interval
+        due = [(now + random.uniform(0, 1 / self.rate), server_name) for server_name in servers]
+        heapq.heapify(due)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                start, server_name = due[0]
+                delay = start - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                # After a stall, resume from now instead of firing every missed slot at once
+                heapq.heapreplace(due, (max(start, time.monotonic() - 1 / self.rate) + self._gap(), server_name))
+                with self._lock:
+                    busy = self._in_flight.get(server_name, 0) >= max_in_flight
+                if busy or not self.breaker(server_name).allow():
+                    self.skipped += 1
+                    continue
+                with self._lock:
+                    self._in_flight[server_name] = self._in_flight.get(server_name, 0) + 1
+                executor.submit(self._run_cycle, server_name, make_cycle(server_name, servers[server_name]))
+
+    def _run_cycle(self, server_name, cycle):
+        try:
+            cycle()
+        finally:
+            with self._lock:
+                self._in_flight[server_name] -= 1
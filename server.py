@@ -1,13 +1,13 @@
 import threading
 import queue
-import uuid
-import hashlib
 import time
 import logging
 import json
-from flask import Flask, request, jsonify
-import tkinter as tk
-from PIL import Image, ImageTk
+import argparse
+from flask import Flask, Response, g, request, jsonify
+from buildings import load_buildings, building_stats, start_token_threads
+import log_pipeline
+from metrics import Metrics, CONTENT_TYPE
 
 # Configuration
 CONFIG_FILE = "server_config.json"
@@ -22,180 +22,295 @@ except FileNotFoundError:
 # Extract configuration values
 BUILDING_NAME = config.get("building_name", "Generic Institution")
 BUILDING_LOGO = config.get("building_logo", "institution_logo.png")
-VALID_CREDENTIALS = config.get("credentials", {})
 SERVER_PORT = config.get("port", 80)
-TOKEN_EXPIRY = config.get("token_expiry", 3600)  # Default: 1 hour
+TOKEN_SNAPSHOT_INTERVAL = config.get("token_snapshot_seconds", 5)
+MAX_BATCH_SIZE = config.get("max_batch_size", 100)  # Items per batch request
 
-# Configure logging
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Configure logging (records are formatted and written off the request thread)
+log_pipeline.setup_logging()
+if config.get("log_aggregate_seconds"):
+    log_pipeline.set_aggregation(config["log_aggregate_seconds"])  # Per-interval counters instead of per-request lines
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
 
-# Token storage (hashed tokens with expiry times)
-valid_tokens = {}
+# Credentials, token store and failed-login throttle per hosted building (server_name -> Building)
+try:
+    buildings = load_buildings(config)
+except (OSError, ValueError) as e:
+    print(f"Error: Invalid building configuration: {e}")
+    exit(1)
+primary_building = next(iter(buildings.values()))  # The building server_config.json describes
+for building in buildings.values():
+    building.restore_tokens()
 
 # Queue for logging and GUI updates
 gui_queue = queue.Queue()
+gui_enabled = False  # Set by main() when the dashboard runs; nothing drains gui_queue under gunicorn or --headless
+
+# Metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+metrics.describe("logins_total", "Login attempts by outcome")
+metrics.describe("actions_total", "Action attempts by outcome")
+metrics.describe("refreshes_total", "Token refresh attempts by outcome")
+metrics.describe("request_duration_seconds", "Request handling time by endpoint")
+metrics.describe("tokens_live", "Live session tokens")
+metrics.describe("gui_queue_depth", "Messages waiting for the dashboard")
+metrics.gauge("tokens_live", lambda: sum(len(building.tokens) for building in buildings.values()))
+metrics.gauge("gui_queue_depth", gui_queue.qsize)
 
 # Function to send messages to the GUI queue
 def send_gui_message(message_type, message):
-    gui_queue.put({"type": message_type, "content": message})
+    if gui_enabled:
+        gui_queue.put({"type": message_type, "content": message})
 
 
-@app.route('/login', methods=['POST'])
-def login() -> tuple:
-    """Handles user login and generates a token."""
-    username = request.form.get('username')
-    password = request.form.get('password')
+def find_building(server_name=None):
+    """Returns the building a request is for: the /<server_name>/ path prefix, else the Host header.
+
+    Requests without a matching Host go to the primary building; an unknown
+    path prefix returns None.
+    """
+    if server_name is not None:
+        return buildings.get(server_name)
+    host = request.host.split(':')[0].split('.')[0]  # "wf:80" or "wf.example.org" -> "wf"
+    return buildings.get(host, primary_building)
 
-    if not username or not password:
+
+def check_login(building, username, password, address):
+    """Checks credentials and issues a token. Returns (response body, status code)."""
+    if building.login_throttle.blocked(address, username):
+        metrics.inc("logins_total", outcome="throttled", building=building.server_name)
+        return {'error': 'Too many failed logins'}, 429  # Rejected before any other work
+
+    # Batch items are arbitrary JSON, so anything but non-empty strings counts as missing
+    if not isinstance(username, str) or not isinstance(password, str) or not username or not password:
         logger.warning("Login attempt with missing username or password.")
         send_gui_message("error", "Login attempt with missing credentials.")
-        return jsonify({'error': 'Missing credentials'}), 400
-
-    if username in VALID_CREDENTIALS and VALID_CREDENTIALS[username] == password:
-        token = str(uuid.uuid4())
-        hashed_token = hashlib.sha256(token.encode()).hexdigest()
-        valid_tokens[hashed_token] = (username, time.time() + TOKEN_EXPIRY)
-        logger.info(f"SUCCESS: {username} logged in.")
-        send_gui_message("log", f"SUCCESS: {username} logged in.")  # Log without token
-        return jsonify({'token': token}), 200
+        metrics.inc("logins_total", outcome="missing_credentials", building=building.server_name)
+        building.login_throttle.record_failure(address, username)
+        return {'error': 'Missing credentials'}, 400
+
+    if username in building.credentials and building.credentials[username] == password:
+        token = building.tokens.issue(username, time.time() + building.token_expiry)
+        logger.info("SUCCESS: %s logged in.", username)
+        metrics.inc("logins_total", outcome="success", building=building.server_name)
+        return {'token': token, 'expires_in': building.token_expiry}, 200
     else:
-        logger.warning(f"FAILURE: Invalid login attempt for username: {username}")
-        send_gui_message("log", f"FAILURE: Invalid login attempt for {username}")
+        building.login_throttle.record_failure(address, username)
+        logger.warning("FAILURE: Invalid login attempt for username: %s", username)
         send_gui_message("error", "Invalid credentials.")
-        return jsonify({'error': 'Invalid credentials'}), 401
+        metrics.inc("logins_total", outcome="invalid_credentials", building=building.server_name)
+        return {'error': 'Invalid credentials'}, 401
 
 
-@app.route('/action', methods=['GET'])
-def action() -> tuple:
-    """Performs an action if the token is valid."""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        logger.warning("Unauthorized action attempt: Missing or invalid Authorization header.")
-        send_gui_message("error", "Unauthorized: Missing or invalid Authorization header.")
-        return jsonify({'error': 'Unauthorized'}), 401  # 401 for missing auth header
-
-    token = auth_header[7:] # Extract token from "Bearer <token>"
-    hashed_token = hashlib.sha256(token.encode()).hexdigest()
+def check_action(building, token):
+    """Performs an action if the token is valid. Returns (response body, status code)."""
+    entry = building.tokens.get(token)
 
-    if hashed_token in valid_tokens:
-        username, expiry_time = valid_tokens[hashed_token]
+    if entry is not None:
+        username, expiry_time, _ = entry
         if time.time() > expiry_time:
-            del valid_tokens[hashed_token]  # Remove expired token
-            logger.warning(f"Token expired for {username}")
+            building.tokens.remove(token)  # Remove expired token
+            logger.warning("Token expired for %s", username)
             send_gui_message("error", "Token expired.")
-            return jsonify({'error': 'Token expired'}), 401
-
-        logger.info(f"ACTION: {username} performed an action.")
-        send_gui_message("log", f"ACTION: {username} performed an action.")
-        return jsonify({'message': f'Action performed for {username}'}), 200
+            metrics.inc("actions_total", outcome="expired", building=building.server_name)
+            return {'error': 'Token expired'}, 401
+
+        logger.info("ACTION: %s performed an action.", username)
+        metrics.inc("actions_total", outcome="success", building=building.server_name)
+        body = {'message': f'Action performed for {username}'}
+        if building.sliding_expiry and building.tokens.extend(token, time.time() + building.token_expiry):
+            body['expires_in'] = building.token_expiry
+        return body, 200
     else:
-        logger.warning(f"UNAUTHORIZED: Invalid token attempt.")
+        logger.warning("UNAUTHORIZED: Invalid token attempt.")
         send_gui_message("error", "Unauthorized: Invalid token.")
+        metrics.inc("actions_total", outcome="unauthorized", building=building.server_name)
+        return {'error': 'Unauthorized'}, 401
 
 
-        return jsonify({'error': 'Unauthorized'}), 401
+def check_refresh(building, token):
+    """Swaps a still-valid token for a new one with a full expiry. Returns (response body, status code)."""
+    entry = building.tokens.get(token)
+    if entry is not None and time.time() > entry[1]:
+        building.tokens.remove(token)  # Too late to refresh: log in again
+        entry = None
+    new_token = building.tokens.refresh(token, time.time() + building.token_expiry) if entry is not None else None
+    if new_token is None:
+        logger.warning("UNAUTHORIZED: Invalid or expired token refresh attempt.")
+        metrics.inc("refreshes_total", outcome="unauthorized", building=building.server_name)
+        return {'error': 'Unauthorized'}, 401
 
+    logger.info("REFRESH: %s renewed a session.", entry[0])
+    metrics.inc("refreshes_total", outcome="success", building=building.server_name)
+    return {'token': new_token, 'expires_in': building.token_expiry}, 200
 
 
-def run_flask():
+def bearer_token():
+    """Returns the token from an "Authorization: Bearer <token>" header, or None."""
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    return auth_header[7:]
 
-    app.run(host='0.0.0.0', port=SERVER_PORT, debug=False)
 
+def batch_items(key):
+    """Returns the list under key in the JSON body, or an error response tuple."""
+    body = request.get_json(silent=True)
+    items = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        return None, (jsonify({'error': f'Expected a JSON list in "{key}"'}), 400)
+    if len(items) > MAX_BATCH_SIZE:
+        return None, (jsonify({'error': f'Batch larger than {MAX_BATCH_SIZE} items'}), 413)
+    return items, None
 
 
-class ServerGUI:
-    def __init__(self, root):
-        self.root = root
-        self.root.title(f"{BUILDING_NAME} Server Dashboard")
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
 
-        try:
-            self.original_image = Image.open(BUILDING_LOGO)  # Keep original image
 
-            # Get screen dimensions
-            screen_width = root.winfo_screenwidth()
-            screen_height = root.winfo_screenheight()
+@app.after_request
+def record_latency(response):
+    if request.endpoint not in (None, 'metrics_text'):
+        metrics.observe("request_duration_seconds", time.perf_counter() - g.start_time, endpoint=request.endpoint)
+    return response
 
-            # Calculate new image dimensions while maintaining aspect ratio
-            image_width, image_height = self.original_image.size
-            if image_width > screen_width or image_height > screen_height:
-                if image_width / screen_width > image_height / screen_height:
-                    # Width is the limiting factor
-                    new_width = screen_width
-                    new_height = int(image_height * (screen_width / image_width))
-                else:
-                    # Height is the limiting factor
-                    new_height = screen_height
-                    new_width = int(image_width * (screen_height / image_height))
-            else:
-                new_width, new_height = image_width, image_height  # No resize needed
 
-            self.resized_image = self.original_image.resize((new_width, new_height), Image.LANCZOS) # High-quality resize
-            self.photo = ImageTk.PhotoImage(self.resized_image)
-            self.image_label = tk.Label(root, image=self.photo)
-            self.image_label.pack()
-        except FileNotFoundError:
-            logger.error(f"Image file not found: {BUILDING_LOGO}")
-            send_gui_message("error", f"Image file not found: {BUILDING_LOGO}")
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    """Exposes counters, latency histograms and gauges in Prometheus text format."""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
 
 
-        self.clients_label = tk.Label(root, text="Connected Clients: 0", font=("Helvetica", 14))
-        self.clients_label.pack()
+def unknown_building():
+    return jsonify({'error': 'Unknown building'}), 404
 
-        self.log_text = tk.Text(root, height=10, state='disabled')
-        self.log_text.pack(fill=tk.BOTH, expand=True)
 
+@app.route('/login', methods=['POST'])
+@app.route('/<server_name>/login', methods=['POST'])
+def login(server_name=None) -> tuple:
+    """Handles user login and generates a token."""
+    building = find_building(server_name)
+    if building is None:
+        return unknown_building()
+    body, status = check_login(building, request.form.get('username'), request.form.get('password'), request.remote_addr)
+    return jsonify(body), status
+
+
+@app.route('/login/batch', methods=['POST'])
+@app.route('/<server_name>/login/batch', methods=['POST'])
+def login_batch(server_name=None) -> tuple:
+    """Logs in a list of {"username", "password"} credentials in one round trip."""
+    building = find_building(server_name)
+    if building is None:
+        return unknown_building()
+    credentials, error = batch_items('credentials')
+    if error:
+        return error
+    results = []
+    for creds in credentials:
+        if not isinstance(creds, dict):
+            creds = {}
+        body, _ = check_login(building, creds.get('username'), creds.get('password'), request.remote_addr)
+        results.append(body)
+    return jsonify({'results': results}), 200
 
-        self.error_label = tk.Label(root, text="", fg="red")  # For displaying errors
-        self.error_label.pack()
 
-        self.update_gui()
+@app.route('/action', methods=['GET'])
+@app.route('/<server_name>/action', methods=['GET'])
+def action(server_name=None) -> tuple:
+    """Performs an action if the token is valid."""
+    building = find_building(server_name)
+    if building is None:
+        return unknown_building()
+    token = bearer_token()
+    if token is None:
+        logger.warning("Unauthorized action attempt: Missing or invalid Authorization header.")
+        send_gui_message("error", "Unauthorized: Missing or invalid Authorization header.")
+        metrics.inc("actions_total", outcome="unauthorized", building=building.server_name)
+        return jsonify({'error': 'Unauthorized'}), 401  # 401 for missing auth header
+
+    body, status = check_action(building, token)
+    return jsonify(body), status
 
 
+@app.route('/refresh', methods=['POST'])
+@app.route('/<server_name>/refresh', methods=['POST'])
+def refresh(server_name=None) -> tuple:
+    """Exchanges the bearer token for a new one with a full expiry, without the password."""
+    building = find_building(server_name)
+    if building is None:
+        return unknown_building()
+    token = bearer_token()
+    if token is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+    body, status = check_refresh(building, token)
+    return jsonify(body), status
+
+
+@app.route('/actions/batch', methods=['POST'])
+@app.route('/<server_name>/actions/batch', methods=['POST'])
+def action_batch(server_name=None) -> tuple:
+    """Performs one action per token in a list, returning a result for each."""
+    building = find_building(server_name)
+    if building is None:
+        return unknown_building()
+    batch_tokens, error = batch_items('tokens')
+    if error:
+        return error
+    results = []
+    for token in batch_tokens:
+        if isinstance(token, str):
+            body, _ = check_action(building, token)
+        else:
+            body = {'error': 'Unauthorized'}
+        results.append(body)
+    return jsonify({'results': results}), 200
 
-    def update_gui(self):
-        # Check for expired tokens
-        expired_tokens = [token for token, (username, expiry) in valid_tokens.items() if time.time() > expiry]
 
-        for token in expired_tokens:
-            del valid_tokens[token]
-            logger.info(f"Token for {username} expired")
-            send_gui_message("log", f"Token for {username} expired")
 
+def run_flask():
 
-        while not gui_queue.empty():
-            message = gui_queue.get()
+    app.run(host='0.0.0.0', port=SERVER_PORT, debug=False)
 
-            if message["type"] == "log":
-                self.log_message(message["content"])
-            elif message["type"] == "error":
-                self.show_error(message["content"])
 
-        client_count = len(valid_tokens)
-        self.clients_label.config(text=f"Connected Clients: {client_count}")
-        self.root.after(1000, self.update_gui)  # Update every 1000ms (1 second)
 
-    def log_message(self, message):
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state='disabled')
+def start_background_threads():
+    """Starts the expiry sweeper and token snapshots; gunicorn.conf.py calls this in each worker."""
+    start_token_threads(buildings, TOKEN_SNAPSHOT_INTERVAL, logger)
 
-    def show_error(self, message):
-        self.error_label.config(text=message)
-        self.root.after(5000, lambda: self.error_label.config(text=""))  # Clear error after 5 seconds
 
+def server_stats():
+    return building_stats(buildings)
 
 
 def main():
+    global gui_enabled
+    parser = argparse.ArgumentParser(description="Hack the City HTTP server")
+    parser.add_argument('--headless', action='store_true',
+                        help="Serve in the foreground without the Tk dashboard")
+    args = parser.parse_args()
+
+    start_background_threads()
+
+    if args.headless:
+        run_flask()
+        return
+
+    # Deferred so headless runs never import tkinter or PIL
+    import tkinter as tk
+    from dashboard import ServerGUI
+
+    gui_enabled = True
+    log_pipeline.add_queue_handler(gui_queue, logger.name, "log")
     flask_thread = threading.Thread(target=run_flask, daemon=True)
     flask_thread.start()
 
     root = tk.Tk()
-    gui = ServerGUI(root)
+    gui = ServerGUI(root, BUILDING_NAME, BUILDING_LOGO, gui_queue, server_stats)
     root.mainloop()
 
 
@@ -1,13 +1,20 @@
 import threading
 import queue
-import uuid
-import hashlib
 import time
 import logging
 import json
 import socket
-import tkinter as tk
-from PIL import Image, ImageTk
+import asyncio
+import argparse
+import functools
+import multiprocessing
+import os
+import selectors
+from buildings import load_buildings, building_stats, sessions_shared, start_token_threads
+from reply_cache import ReplyCache
+import log_pipeline
+import udp_wire
+from metrics import Metrics, serve_metrics
 
 # Configuration
 CONFIG_FILE = "server_config.json"
@@ -22,172 +29,458 @@ except FileNotFoundError:
 # Extract configuration values
 BUILDING_NAME = config.get("building_name", "Generic Institution")
 BUILDING_LOGO = config.get("building_logo", "institution_logo.png")
-VALID_CREDENTIALS = config.get("credentials", {})
 SERVER_PORT = config.get("port", 80)  # Not used in UDP version
-TOKEN_EXPIRY = config.get("token_expiry", 3600)  # Default: 1 hour
-
-# Configure logging
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+TOKEN_SNAPSHOT_INTERVAL = config.get("token_snapshot_seconds", 5)
+MAX_BATCH_SIZE = config.get("max_batch_size", 100)  # Requests per batch datagram
+UDP_RCVBUF = config.get("udp_rcvbuf")  # SO_RCVBUF in bytes, to absorb bursts; None keeps the OS default
+METRICS_PORT = config.get("metrics_port")  # HTTP port for Prometheus-style stats; None disables
+UDP_BIND_ADDRESS = config.get("udp_bind_address")  # Unicast address --workers bind; None uses the default route's
+
+# Configure logging (records are formatted and written off the request thread)
+log_pipeline.setup_logging()
+if config.get("log_aggregate_seconds"):
+    log_pipeline.set_aggregation(config["log_aggregate_seconds"])  # Per-interval counters instead of per-request lines
 logger = logging.getLogger(__name__)
 
-# Token storage (hashed tokens with expiry times)
-valid_tokens = {}
+# Credentials, token store and failed-login throttle per hosted building (server_name -> Building)
+try:
+    buildings = load_buildings(config)
+except (OSError, ValueError) as e:
+    print(f"Error: Invalid building configuration: {e}")
+    exit(1)
+primary_building = next(iter(buildings.values()))  # The building server_config.json describes
+for building in buildings.values():
+    building.restore_tokens()
+buildings_by_id = {udp_wire.building_id(name): building for name, building in buildings.items()}
+
+# Recent replies by (client_id, request_id), so retransmitted requests are answered without redoing them
+reply_cache = ReplyCache(config.get("reply_cache_size", 10000), config.get("reply_cache_seconds", 30))
 
 # Queue for logging and GUI updates
 gui_queue = queue.Queue()
+gui_enabled = False  # Set by main() when the dashboard runs; nothing drains gui_queue otherwise
+
+# Metrics, served as Prometheus text on METRICS_PORT
+metrics = Metrics()
+metrics.describe("datagrams_received_total", "Datagrams received, including ones for other buildings")
+metrics.describe("logins_total", "Login attempts by outcome")
+metrics.describe("actions_total", "Action attempts by outcome")
+metrics.describe("refreshes_total", "Token refresh attempts by outcome")
+metrics.describe("duplicate_requests_total", "Retransmitted requests answered from the reply cache")
+metrics.describe("replies_dropped_total", "Replies dropped because the socket send buffer was full")
+metrics.describe("request_duration_seconds", "Request handling time by request type")
+metrics.describe("tokens_live", "Live session tokens")
+metrics.describe("gui_queue_depth", "Messages waiting for the dashboard")
+metrics.gauge("tokens_live", lambda: sum(len(building.tokens) for building in buildings.values()))
+metrics.gauge("gui_queue_depth", gui_queue.qsize)
+
+# Cheap pre-filter for JSON broadcasts meant for other buildings (single-building servers only)
+SERVER_NAME_BYTES = primary_building.server_name.encode() if len(buildings) == 1 and primary_building.server_name else None
 
 # UDP Socket
 udp_port = 5005  # Port for UDP communication
+MAX_DATAGRAM_SIZE = 65535
 broadcast_address = '255.255.255.255'  # Define broadcast address here
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # Enable broadcasting
-sock.bind(('', udp_port))
-sock.settimeout(1)
+socks = []  # Bound by open_socket() or open_worker_sockets() in the serving process
+
+# --workers mode: worker id -> latest counts reported to the dashboard process
+worker_count = 0
+worker_stats = {}
+
+
+def bind_udp(address='', reuse_port=False):
+    """Returns a non-blocking UDP socket bound to address:udp_port."""
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # Enable broadcasting
+    if reuse_port:
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if UDP_RCVBUF:
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+        # The kernel may double or cap the request (see net.core.rmem_max on Linux)
+        logger.info("UDP receive buffer: %s bytes", udp_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+    udp_sock.bind((address, udp_port))
+    udp_sock.setblocking(False)
+    return udp_sock
+
+
+def open_socket():
+    socks.append(bind_udp())
+
+
+def unicast_address():
+    """The host address --workers bind: udp_bind_address, else the source address of the default route."""
+    if UDP_BIND_ADDRESS:
+        return UDP_BIND_ADDRESS
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        probe.connect((broadcast_address, udp_port))  # Picks the interface broadcasts leave by; nothing is sent
+        return probe.getsockname()[0]
+    finally:
+        probe.close()
+
+
+def open_worker_sockets(worker_id):
+    """Joins the SO_REUSEPORT groups on the unicast and loopback addresses; worker 0 also takes broadcasts.
+
+    Linux copies a broadcast to every socket in a SO_REUSEPORT group, so a
+    group on the wildcard address would answer each broadcast once per
+    worker. Sockets bound to a unicast address never see broadcasts, and
+    unicast datagrams prefer them over the wildcard socket, so only worker
+    0's wildcard socket answers broadcasts while the groups share unicast
+    traffic.
+    """
+    for address in dict.fromkeys([unicast_address(), '127.0.0.1']):
+        socks.append(bind_udp(address, reuse_port=True))
+    if worker_id == 0:
+        socks.append(bind_udp(reuse_port=True))  # SO_REUSEPORT is needed to share the port with the groups
+
 
 # Function to send messages to the GUI queue
 def send_gui_message(message_type, message):
-    gui_queue.put({"type": message_type, "content": message})
+    if gui_enabled:
+        gui_queue.put({"type": message_type, "content": message})
+
+def handle_datagram(data, addr, send):
+    """Handles one request datagram, passing replies to send(payload, address).
+
+    data may be a memoryview into a reused receive buffer; binary frames are
+    parsed in place and only JSON datagrams are copied.
+    """
+    metrics.inc("datagrams_received_total")
+    if not udp_wire.is_binary(data):
+        data = bytes(data)
+        if SERVER_NAME_BYTES and SERVER_NAME_BYTES not in data:
+            return  # Cheap pre-filter for broadcasts meant for another building
+
+    try:
+        request, binary = udp_wire.loads(data)
+    except ValueError:
+        logger.warning("Received malformed datagram.")
+        return
+    if not isinstance(request, dict):
+        logger.warning("Received malformed datagram.")
+        return
+
+    building = find_building(request, binary)
+    if building is None:
+        return  # Addressed to a building this server does not host
+
+    cache_key = None
+    # Only well-formed ids are cached; raw JSON values may be unhashable
+    if isinstance(request.get('request_id'), str) and isinstance(request.get('client_id'), str):
+        cache_key = (request['client_id'], request['request_id'])
+        response = reply_cache.get(cache_key)
+        if response is not None:
+            metrics.inc("duplicate_requests_total")
+            send_response(response, request, binary, addr, send)
+            return
+
+    # Clients choose the type, so unknown ones share one series instead of growing the registry
+    request_type = request.get('type') if request.get('type') in ('login', 'action', 'refresh', 'batch') else 'other'
+    with metrics.timer("request_duration_seconds", type=request_type):
+        response = process_request(request, addr, building)
+    if response is not None:
+        if cache_key is not None:
+            reply_cache.put(cache_key, response)
+        send_response(response, request, binary, addr, send)
+
+
+def send_response(response, request, binary, addr, send):
+    # Answer in the format the request came in; JSON replies advertise binary support
+    if binary:
+        response = dict(response, building_id=request['building_id'])
+    else:
+        response = dict(response, wire=udp_wire.VERSION)
+    send(udp_wire.dumps(response, binary), addr)  # Send directly to client
+
+
+def find_building(request, binary):
+    """Returns the hosted building a request is addressed to, or None."""
+    if primary_building.server_name is None:
+        return primary_building  # No server_name configured: answer everything
+    if binary:
+        return buildings_by_id.get(request['building_id'])
+    server_name = request.get('server_name')
+    return buildings.get(server_name) if isinstance(server_name, str) else None
+
+
+def process_request(request, addr, building):
+    """Runs a login, action, refresh or batch request for building and returns the response, or None to stay silent."""
+    request_id = request.get('request_id')
+    server_name = request.get('server_name')
+
+    if request.get('type') == 'login':
+        username = request.get('username')
+        password = request.get('password')
+        client_id = request.get('client_id') if isinstance(request.get('client_id'), str) else None
+
+        if building.login_throttle.blocked(addr[0], username):
+            metrics.inc("logins_total", outcome="throttled", building=building.server_name)
+            return {'error': 'Too many failed logins', 'request_id': request_id, 'server_name': server_name}
+
+        # JSON fields can be any type; anything but non-empty strings counts as missing
+        if not isinstance(username, str) or not isinstance(password, str) or not username or not password:
+            building.login_throttle.record_failure(addr[0], username)
+            logger.warning("Login attempt with missing username or password from %s:%s.", addr[0], addr[1])
+            metrics.inc("logins_total", outcome="missing_credentials", building=building.server_name)
+            return {'error': 'Missing credentials', 'request_id': request_id, 'server_name': server_name}
+
+        if username in building.credentials and building.credentials[username] == password:
+            token = building.tokens.issue(username, time.time() + building.token_expiry, client_id)
+            logger.info("SUCCESS: %s logged in from %s:%s.", username, addr[0], addr[1])
+            metrics.inc("logins_total", outcome="success", building=building.server_name)
+            return {'token': token, 'expires_in': building.token_expiry, 'request_id': request_id, 'server_name': server_name}
+        else:
+            building.login_throttle.record_failure(addr[0], username)
+            logger.warning("FAILURE: Invalid login attempt for username: %s from %s:%s.", username, addr[0], addr[1])
+            metrics.inc("logins_total", outcome="invalid_credentials", building=building.server_name)
+            return {'error': 'Invalid credentials', 'request_id': request_id, 'server_name': server_name}
+
+    elif request.get('type') == 'action':
+        token = request.get('token')
+        entry = building.tokens.get(token) if isinstance(token, str) else None
+        if entry is not None:
+            username, expiry_time, client_id = entry
+            if client_id == request.get('client_id') and time.time() <= expiry_time:
+                logger.info("ACTION: %s performed an action from %s:%s.", username, addr[0], addr[1])
+                metrics.inc("actions_total", outcome="success", building=building.server_name)
+                response = {'message': f'Action performed for {username}', 'request_id': request_id, 'server_name': server_name}
+                if building.sliding_expiry and building.tokens.extend(token, time.time() + building.token_expiry):
+                    response['expires_in'] = building.token_expiry
+                return response
 
-def process_udp_requests():
-    while True:
-        try:
-            data, addr = sock.recvfrom(1024)
-            request = json.loads(data.decode())
-            request_id = request.get('request_id')
-            server_name = request.get('server_name')
-
-            if request['type'] == 'login':
-                username = request['username']
-                password = request['password']
-
-                if username in VALID_CREDENTIALS and VALID_CREDENTIALS[username] == password:
-                    token = str(uuid.uuid4())
-                    hashed_token = hashlib.sha256(token.encode()).hexdigest()
-                    valid_tokens[hashed_token] = (username, time.time() + TOKEN_EXPIRY, request.get('client_id'))
-                    response = {'token': token, 'request_id': request_id, 'server_name': server_name}
-                    sock.sendto(json.dumps(response).encode(), (addr[0], udp_port))  # Send directly to client
-                    logger.info(f"SUCCESS: {username} logged in from {addr[0]}:{addr[1]}.")
-                    send_gui_message("log", f"SUCCESS: {username} logged in from {addr[0]}:{addr[1]}.")
-                else:
-                    response = {'error': 'Invalid credentials', 'request_id': request_id, 'server_name': server_name}
-                    sock.sendto(json.dumps(response).encode(), (addr[0], udp_port))
-                    logger.warning(f"FAILURE: Invalid login attempt for username: {username} from {addr[0]}:{addr[1]}.")
-                    send_gui_message("log", f"FAILURE: Invalid login attempt for {username} from {addr[0]}:{addr[1]}.")
-
-            elif request['type'] == 'action':
-                token = request.get('token')
-                hashed_token = hashlib.sha256(token.encode()).hexdigest()
-                if hashed_token in valid_tokens:
-                    username, expiry_time, client_id = valid_tokens[hashed_token]
-                    if client_id == request.get('client_id') and time.time() <= expiry_time:
-                        logger.info(f"ACTION: {username} performed an action from {addr[0]}:{addr[1]}.")
-                        send_gui_message("log", f"ACTION: {username} performed an action from {addr[0]}:{addr[1]}.")
-                        response = {'message': f'Action performed for {username}', 'request_id': request_id, 'server_name': server_name}
-                        sock.sendto(json.dumps(response).encode(), (addr[0], udp_port))  # Send directly to client
-
-                    else:
-                        response = {'error': 'Token expired or invalid client', 'request_id': request_id, 'server_name': server_name}
-                        sock.sendto(json.dumps(response).encode(), (addr[0], udp_port))
-                        logger.warning(f"UNAUTHORIZED: Invalid token or client ID attempt from {addr[0]}:{addr[1]}.")
-
-                        if time.time() > expiry_time:
-                            del valid_tokens[hashed_token]
-                else:
-                     response = {'error': 'Unauthorized', 'request_id': request_id, 'server_name': server_name}
-                     sock.sendto(json.dumps(response).encode(), (addr[0], udp_port))
-                     logger.warning(f"UNAUTHORIZED: Invalid token attempt from {addr[0]}:{addr[1]}.")
-
-        except socket.timeout:
-            pass  # No data received within timeout
-        except json.JSONDecodeError:
-            logger.warning("Received non-JSON data or malformed JSON data.")
-
-class ServerGUI:
-    def __init__(self, root):
-        self.root = root
-        self.root.title(f"{BUILDING_NAME} Server Dashboard")
-
-        try:
-            self.original_image = Image.open(BUILDING_LOGO)  # Keep original image
-
-            # Get screen dimensions
-            screen_width = root.winfo_screenwidth()
-            screen_height = root.winfo_screenheight()
-
-            # Calculate new image dimensions while maintaining aspect ratio
-            image_width, image_height = self.original_image.size
-            if image_width > screen_width or image_height > screen_height:
-                if image_width / screen_width > image_height / screen_height:
-                    # Width is the limiting factor
-                    new_width = screen_width
-                    new_height = int(image_height * (screen_width / image_width))
+            else:
+                logger.warning("UNAUTHORIZED: Invalid token or client ID attempt from %s:%s.", addr[0], addr[1])
+                if time.time() > expiry_time:
+                    building.tokens.remove(token)
+                    metrics.inc("actions_total", outcome="expired", building=building.server_name)
                 else:
-                    # Height is the limiting factor
-                    new_height = screen_height
-                    new_width = int(image_width * (screen_height / image_height))
+                    metrics.inc("actions_total", outcome="invalid_client", building=building.server_name)
+                return {'error': 'Token expired or invalid client', 'request_id': request_id, 'server_name': server_name}
+        else:
+            logger.warning("UNAUTHORIZED: Invalid token attempt from %s:%s.", addr[0], addr[1])
+            metrics.inc("actions_total", outcome="unauthorized", building=building.server_name)
+            return {'error': 'Unauthorized', 'request_id': request_id, 'server_name': server_name}
+
+    elif request.get('type') == 'refresh':
+        token = request.get('token')
+        entry = building.tokens.get(token) if isinstance(token, str) else None
+        if entry is not None and time.time() > entry[1]:
+            building.tokens.remove(token)  # Too late to refresh: log in again
+            entry = None
+        new_token = None
+        if entry is not None and entry[2] == request.get('client_id'):
+            new_token = building.tokens.refresh(token, time.time() + building.token_expiry)
+        if new_token is None:
+            logger.warning("UNAUTHORIZED: Invalid token refresh attempt from %s:%s.", addr[0], addr[1])
+            metrics.inc("refreshes_total", outcome="unauthorized", building=building.server_name)
+            return {'error': 'Unauthorized', 'request_id': request_id, 'server_name': server_name}
+        logger.info("REFRESH: %s renewed a session from %s:%s.", entry[0], addr[0], addr[1])
+        metrics.inc("refreshes_total", outcome="success", building=building.server_name)
+        return {'token': new_token, 'expires_in': building.token_expiry, 'request_id': request_id, 'server_name': server_name}
+
+    elif request.get('type') == 'batch':
+        items = request.get('requests')
+        if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+            return {'error': 'Invalid batch', 'request_id': request_id, 'server_name': server_name}
+        responses = []
+        for item in items:
+            if isinstance(item, dict) and item.get('type') in ('login', 'action', 'refresh'):
+                item_response = process_request(item, addr, building)
+                item_response.pop('server_name', None)  # Already on the batch envelope
+                responses.append(item_response)
             else:
-                new_width, new_height = image_width, image_height  # No resize needed
-
-            self.resized_image = self.original_image.resize((new_width, new_height), Image.LANCZOS) # High-quality resize
-            self.photo = ImageTk.PhotoImage(self.resized_image)
-            self.image_label = tk.Label(root, image=self.photo)
-            self.image_label.pack()
-        except FileNotFoundError:
-            logger.error(f"Image file not found: {BUILDING_LOGO}")
-            send_gui_message("error", f"Image file not found: {BUILDING_LOGO}")
-
-        self.clients_label = tk.Label(root, text="Connected Clients: 0", font=("Helvetica", 14))
-        self.clients_label.pack()
-
-        self.log_text = tk.Text(root, height=10, state='disabled')
-        self.log_text.pack(fill=tk.BOTH, expand=True)
-
-        self.error_label = tk.Label(root, text="", fg="red")  # For displaying errors
-        self.error_label.pack()
+                responses.append({'error': 'Invalid request', 'request_id': item.get('request_id') if isinstance(item, dict) else None})
+        return {'responses': responses, 'request_id': request_id, 'server_name': server_name}
 
-        self.update_gui()
+    return None
 
 
+def send_reply(reply_sock, payload, addr):
+    try:
+        reply_sock.sendto(payload, addr)
+    except BlockingIOError:
+        metrics.inc("replies_dropped_total")  # Send buffer full; the client will retry
 
-    def update_gui(self):
-        # Check for expired tokens
-        expired_tokens = [token for token, (username, expiry, client_id) in valid_tokens.items() if time.time() > expiry] # Fix: unpack client_id
 
-        for token in expired_tokens:
-            del valid_tokens[token]
-            logger.info(f"Token for {username} expired")
-            send_gui_message("log", f"Token for {username} expired")
+def process_udp_requests():
+    """Thread engine: sleeps until a socket is readable, then drains every queued datagram.
+
+    Datagrams are received into one preallocated buffer and handed on as
+    memoryview slices, so the loop allocates nothing per packet. Replies
+    leave through the socket the request arrived on.
+    """
+    buffer = bytearray(MAX_DATAGRAM_SIZE)
+    view = memoryview(buffer)
+    selector = selectors.DefaultSelector()
+    for udp_sock in socks:
+        selector.register(udp_sock, selectors.EVENT_READ, functools.partial(send_reply, udp_sock))
+    while True:
+        for key, _ in selector.select():
+            udp_sock, send = key.fileobj, key.data
+            while True:
+                try:
+                    nbytes, addr = udp_sock.recvfrom_into(buffer)
+                except (BlockingIOError, InterruptedError):
+                    break  # Drained
+                except ConnectionResetError:
+                    continue  # ICMP port unreachable from an earlier reply (Windows)
+                try:
+                    handle_datagram(view[:nbytes], addr, send)
+                except Exception:
+                    logger.exception("Failed to handle datagram from %s:%s.", addr[0], addr[1])  # Keep serving
+
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    """Event-driven engine: the loop sleeps until a datagram arrives instead of polling."""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        handle_datagram(data, addr, self.transport.sendto)
+
+    def error_received(self, exc):
+        logger.warning(f"UDP socket error: {exc}")
+
+
+async def serve_udp_requests():
+    loop = asyncio.get_running_loop()
+    transports = []
+    for udp_sock in socks:
+        transport, protocol = await loop.create_datagram_endpoint(UDPServerProtocol, sock=udp_sock)
+        transports.append(transport)
+    try:
+        await loop.create_future()  # Serve until the loop is stopped
+    finally:
+        for transport in transports:
+            transport.close()
+
+
+def run_asyncio_server():
+    asyncio.run(serve_udp_requests())
+
+
+ENGINES = {'thread': process_udp_requests, 'asyncio': run_asyncio_server}
+
+
+def run_worker(worker_id, engine, report_queue, parent_pid):
+    """Entry point of a --workers process; log lines, errors and counts go to report_queue."""
+    global gui_queue, gui_enabled
+    open_worker_sockets(worker_id)
+    threading.Thread(target=watch_parent, args=(parent_pid,), daemon=True).start()
+    if METRICS_PORT:
+        serve_metrics(metrics, METRICS_PORT + worker_id)
+    if report_queue is not None:
+        gui_queue = report_queue
+        gui_enabled = True
+        log_pipeline.add_queue_handler(report_queue, logger.name, "log")
+        threading.Thread(target=report_stats, args=(worker_id, report_queue), daemon=True).start()
+    ENGINES[engine]()
+
+
+def watch_parent(parent_pid):
+    """Exits once the parent is gone, so orphaned workers do not keep a share of the port."""
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(0)
+
+
+def worker_counts():
+    return {
+        "Datagrams": metrics.value("datagrams_received_total"),
+        "Logins": sum(metrics.value("logins_total", outcome="success", building=name) for name in buildings),
+        "Actions": sum(metrics.value("actions_total", outcome="success", building=name) for name in buildings),
+        "Throttled Logins": sum(building.login_throttle.rejected for building in buildings.values()),
+    }
+
+
+def report_stats(worker_id, report_queue):
+    while True:
+        time.sleep(1)
+        report_queue.put({"type": "stats", "worker": worker_id, "content": worker_counts()})
 
-        while not gui_queue.empty():
-            message = gui_queue.get()
 
-            if message["type"] == "log":
-                self.log_message(message["content"])
-            elif message["type"] == "error":
-                self.show_error(message["content"])
+def collect_reports(report_queue):
+    """Dashboard process: keeps the workers' counts and forwards their messages to gui_queue."""
+    while True:
+        message = report_queue.get()
+        if message["type"] == "stats":
+            worker_stats[message["worker"]] = message["content"]
+        else:
+            gui_queue.put(message)
 
-        client_count = len(valid_tokens)
-        self.clients_label.config(text=f"Connected Clients: {client_count}")
-        self.root.after(1000, self.update_gui)  # Update every 1000ms (1 second)
 
-    def log_message(self, message):
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state='disabled')
+def start_workers(count, engine, report_queue):
+    # Spawned rather than forked so no threads or SQLite connections are inherited
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(worker_id, engine, report_queue, os.getpid()), daemon=True)
+               for worker_id in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
 
-    def show_error(self, message):
-        self.error_label.config(text=message)
-        self.root.after(5000, lambda: self.error_label.config(text=""))  # Clear error after 5 seconds
 
+def server_stats():
+    if not worker_count:
+        return building_stats(buildings)
+    stats = {"Connected Clients": sum(len(building.tokens) for building in buildings.values()), "Workers": worker_count}
+    for name in ("Datagrams", "Logins", "Actions", "Throttled Logins"):
+        stats[name] = sum(counts[name] for counts in list(worker_stats.values()))
+    return stats
 
 
 def main():
-    udp_thread = threading.Thread(target=process_udp_requests, daemon=True)
+    global gui_enabled, worker_count
+    parser = argparse.ArgumentParser(description="Hack the City UDP server")
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help="Request engine: blocking receive thread or asyncio DatagramProtocol")
+    parser.add_argument('--headless', action='store_true',
+                        help="Serve in the foreground without the Tk dashboard")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes sharing the UDP port through SO_REUSEPORT")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error("--workers needs SO_REUSEPORT, which this platform does not have")
+        if not sessions_shared([building.config for building in buildings.values()]):
+            parser.error("--workers needs token_mode 'sqlite', or 'hmac' with a token_secret, so workers share sessions")
+
+    start_token_threads(buildings, TOKEN_SNAPSHOT_INTERVAL, logger)
+
+    if args.workers > 1:
+        worker_count = args.workers
+        report_queue = None if args.headless else multiprocessing.get_context('spawn').Queue()
+        workers = start_workers(args.workers, args.engine, report_queue)
+        logger.info("Started %s workers on UDP port %s", args.workers, udp_port)
+        if args.headless:
+            for worker in workers:
+                worker.join()
+            return
+        serve = functools.partial(collect_reports, report_queue)
+    else:
+        open_socket()
+        serve = ENGINES[args.engine]
+        if METRICS_PORT:
+            serve_metrics(metrics, METRICS_PORT)
+            logger.info("Serving metrics on port %s", METRICS_PORT)
+        if args.headless:
+            serve()
+            return
+
+    # Deferred so headless runs never import tkinter or PIL
+    import tkinter as tk
+    from dashboard import ServerGUI
+
+    gui_enabled = True
+    log_pipeline.add_queue_handler(gui_queue, logger.name, "log")
+    udp_thread = threading.Thread(target=serve, daemon=True)
     udp_thread.start()
 
     root = tk.Tk()
-    gui = ServerGUI(root)
+    gui = ServerGUI(root, BUILDING_NAME, BUILDING_LOGO, gui_queue, server_stats)
     root.mainloop()
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+"""Token-bucket throttling of failed logins, shared by the HTTP and UDP servers.
+
+Each source address and each username has a bucket holding up to burst
+tokens that refills at rate tokens per second. A failed login takes a token;
+while either bucket is empty, further logins for that address or username
+are rejected before the credentials are checked. Successful logins cost
+nothing. Buckets live in an LRU table capped at max_entries, so a flood of
+distinct addresses or usernames cannot grow memory without bound.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketTable:
+    """LRU-bounded map of key -> token bucket."""
+
+    def __init__(self, rate, burst, max_entries):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()  # key -> [tokens, last refill time]
+        self.evictions = 0
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return None
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        self._buckets.move_to_end(key)
+        return bucket
+
+    def allows(self, key, now):
+        """True if key has a whole token left (unknown keys start full)."""
+        bucket = self._bucket(key, now)
+        return bucket is None or bucket[0] >= 1
+
+    def take(self, key, now):
+        bucket = self._bucket(key, now)
+        if bucket is None:
+            self._buckets[key] = [self.burst - 1, now]
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)  # Forget the least recently seen key
+                self.evictions += 1
+        else:
+            bucket[0] = max(0.0, bucket[0] - 1)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LoginThrottle:
+    """Failed-login buckets per source address and per username."""
+
+    def __init__(self, rate=1.0, burst=10, max_entries=10000):
+        self.by_address = TokenBucketTable(rate, burst, max_entries)
+        self.by_username = TokenBucketTable(rate, burst, max_entries)
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def blocked(self, address, username, now=None):
+        """True if this login must be rejected without checking the credentials."""
+        now = time.monotonic() if now is None else now
+        key = username if isinstance(username, str) else None
+        with self.lock:
+            if self.by_address.allows(address, now) and (key is None or self.by_username.allows(key, now)):
+                return False
+            self.rejected += 1
+            return True
+
+    def record_failure(self, address, username, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.by_address.take(address, now)
+            if isinstance(username, str):
+                self.by_username.take(username, now)
+
+    def stats(self):
+        """Dashboard statistics."""
+        return {
+            "Throttled Logins": self.rejected,
+            "Tracked Sources": len(self.by_address),
+        }
+
+
+def create_login_throttle(config):
+    """Builds the throttle from the failed_login_* keys in server_config.json."""
+    return LoginThrottle(config.get("failed_login_rate", 1.0),  # Failed logins per second, sustained
+                         config.get("failed_login_burst", 10),
+                         config.get("throttle_max_entries", 10000))
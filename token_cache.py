@@ -0,0 +1,58 @@
+import threading
+import time
+
+REFRESH_MARGIN = 30  # Seconds before expiry at which a cached token is refreshed
+
+
+class TokenCache:
+    """Client-side cache of session tokens, keyed by server and username.
+
+    A cached token is handed out until it is within the refresh margin of the
+    expiry the server returned with it (expires_in), or until it is
+    invalidated after the server rejected it. Between the refresh time and
+    the expiry it can still be exchanged for a new one (get_refreshable).
+    """
+
+    def __init__(self, refresh_margin=REFRESH_MARGIN):
+        self._lock = threading.Lock()
+        self._tokens = {}  # key -> (token, refresh time, expiry time), times None if the server sent no expiry
+        self.refresh_margin = refresh_margin
+
+    def get(self, key):
+        """Returns the cached token for key, or None if it is missing or due for refresh."""
+        with self._lock:
+            cached = self._tokens.get(key)
+        if cached is None:
+            return None
+        token, refresh_at, _ = cached
+        if refresh_at is not None and time.time() >= refresh_at:
+            return None
+        return token
+
+    def get_refreshable(self, key):
+        """Returns the cached token for key if it is due for refresh but has not expired, else None."""
+        with self._lock:
+            cached = self._tokens.get(key)
+        if cached is None or cached[2] is None:
+            return None
+        token, refresh_at, expires_at = cached
+        if refresh_at <= time.time() < expires_at:
+            return token
+        return None
+
+    def put(self, key, token, expires_in=None):
+        refresh_at = expires_at = None
+        if expires_in is not None:
+            now = time.time()
+            # Never refresh earlier than halfway through a short-lived token
+            refresh_at = now + max(expires_in - self.refresh_margin, expires_in / 2)
+            expires_at = now + expires_in
+        with self._lock:
+            self._tokens[key] = (token, refresh_at, expires_at)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._tokens.pop(key, None)
+
+    def __len__(self):
+        return len(self._tokens)
@@ -0,0 +1,399 @@
+import threading
+import heapq
+import hashlib
+import hmac
+import base64
+import json
+import uuid
+import time
+import logging
+import os
+import secrets
+import sqlite3
+import struct
+import tempfile
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Snapshot file: magic, then per token its SHA-256 hash, expiry and a JSON [username, client_id]
+SNAPSHOT_MAGIC = b'HTCTOK1\n'
+SNAPSHOT_RECORD = struct.Struct('!32sdH')  # hash, expiry, JSON length
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenStore:
+    """Thread-safe storage for hashed session tokens, indexed by expiry.
+
+    Entries live in a dict for O(1) lookups and in a min-heap ordered by
+    expiry time, so expire() only does work for tokens that actually expired
+    instead of scanning every live session.
+
+    Memory is bounded by max_tokens live sessions in total and max_per_user
+    per username (None means unlimited). The dict and a username -> tokens
+    index are kept in least-recently-used order; when a cap is hit, the
+    session used longest ago is evicted.
+    """
+
+    def __init__(self, max_tokens=None, max_per_user=None):
+        self._lock = threading.Lock()
+        self._tokens = OrderedDict()  # hashed token -> (username, expiry, client_id), least recently used first
+        self._by_user = {}  # username -> OrderedDict of that user's hashed tokens, least recently used first
+        self._heap = []  # (expiry, hashed token), may contain stale entries
+        self._version = 0  # Bumped on every change, so save() can skip unchanged tables
+        self._saved_version = 0
+        self._save_lock = threading.Lock()  # One save at a time: snapshot thread and exit handler
+        self.max_tokens = max_tokens
+        self.max_per_user = max_per_user
+        self.evictions = 0
+
+    def issue(self, username, expiry, client_id=None):
+        """Creates a new token for username and returns it (unhashed)."""
+        token = str(uuid.uuid4())
+        hashed_token = hash_token(token)
+        with self._lock:
+            self._add(hashed_token, (username, expiry, client_id))
+            self._version += 1
+        return token
+
+    def get(self, token):
+        """Returns (username, expiry, client_id) for token, or None if unknown."""
+        hashed_token = hash_token(token)
+        with self._lock:
+            entry = self._tokens.get(hashed_token)
+            if entry is not None:
+                self._touch(hashed_token, entry[0])
+            return entry
+
+    def refresh(self, token, expiry):
+        """Replaces token with a new one expiring at expiry, in one step.
+
+        Returns the new token, or None if token is unknown (e.g. already refreshed).
+        """
+        new_token = str(uuid.uuid4())
+        hashed_token = hash_token(token)
+        new_hashed_token = hash_token(new_token)
+        with self._lock:
+            entry = self._discard(hashed_token)
+            if entry is None:
+                return None
+            self._add(new_hashed_token, (entry[0], expiry, entry[2]))
+            self._version += 1
+        return new_token
+
+    def extend(self, token, expiry):
+        """Moves token's expiry to expiry (sliding sessions). Returns False if token is unknown."""
+        hashed_token = hash_token(token)
+        with self._lock:
+            entry = self._tokens.get(hashed_token)
+            if entry is None:
+                return False
+            self._tokens[hashed_token] = (entry[0], expiry, entry[2])
+            self._touch(hashed_token, entry[0])
+            heapq.heappush(self._heap, (expiry, hashed_token))  # The old heap entry goes stale
+            self._version += 1
+            self._compact()
+        return True
+
+    def remove(self, token):
+        with self._lock:
+            if self._discard(hash_token(token)) is not None:
+                self._version += 1
+            self._compact()
+
+    def expire(self, now=None):
+        """Removes expired tokens and returns the usernames they belonged to."""
+        if now is None:
+            now = time.time()
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                expiry, hashed_token = heapq.heappop(self._heap)
+                entry = self._tokens.get(hashed_token)
+                # Skip heap entries for tokens already removed, evicted or extended
+                if entry is not None and entry[1] == expiry:
+                    self._discard(hashed_token)
+                    expired.append(entry[0])
+            if expired:
+                self._version += 1
+        return expired
+
+    def sessions(self, username):
+        """Number of live sessions for username."""
+        with self._lock:
+            return len(self._by_user.get(username, ()))
+
+    def save(self, path):
+        """Writes the token table to path if it changed since the last save.
+
+        The file is written to a fresh temporary file next to path, fsynced
+        and renamed over it, and the directory is fsynced after the rename, so
+        a crash leaves either the old or the new snapshot. Saves are
+        serialized, so the snapshot thread and the exit handler cannot
+        interleave. Only token hashes are stored.
+        """
+        with self._save_lock:
+            with self._lock:
+                version = self._version
+                if version == self._saved_version:
+                    return
+                entries = list(self._tokens.items())
+            chunks = [SNAPSHOT_MAGIC]
+            for hashed_token, (username, expiry, client_id) in entries:
+                fields = json.dumps([username, client_id], separators=(',', ':')).encode()
+                chunks.append(SNAPSHOT_RECORD.pack(bytes.fromhex(hashed_token), expiry, len(fields)) + fields)
+            directory = os.path.dirname(path) or '.'
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(b''.join(chunks))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, path)
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+            if os.name == 'posix':  # Directories cannot be opened for fsync on Windows
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)  # Make the rename itself durable
+                finally:
+                    os.close(dir_fd)
+            with self._lock:
+                self._saved_version = version
+
+    def load(self, path, now=None):
+        """Adds the unexpired tokens from a snapshot written by save(). Returns how many were loaded.
+
+        Raises ValueError if the file is not a valid snapshot.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError(f"{path} is not a token snapshot")
+        loaded = []
+        offset = len(SNAPSHOT_MAGIC)
+        try:
+            while offset < len(data):
+                raw_hash, expiry, length = SNAPSHOT_RECORD.unpack_from(data, offset)
+                offset += SNAPSHOT_RECORD.size
+                username, client_id = json.loads(data[offset:offset + length])
+                offset += length
+                if expiry >= now:
+                    loaded.append((raw_hash.hex(), (username, expiry, client_id)))
+        except (struct.error, ValueError, TypeError) as e:
+            raise ValueError(f"Corrupt token snapshot {path}: {e}")
+        with self._lock:
+            for hashed_token, entry in loaded:
+                self._add(hashed_token, entry)  # Snapshots are in LRU order, so caps evict the right sessions
+        return len(loaded)
+
+    def _add(self, hashed_token, entry):
+        """Inserts an entry as the most recently used, evicting the LRU session past either cap."""
+        self._tokens[hashed_token] = entry
+        heapq.heappush(self._heap, (entry[1], hashed_token))
+        user_tokens = self._by_user.setdefault(entry[0], OrderedDict())
+        user_tokens[hashed_token] = None
+        if self.max_per_user is not None and len(user_tokens) > self.max_per_user:
+            self._discard(next(iter(user_tokens)))
+            self.evictions += 1
+        if self.max_tokens is not None and len(self._tokens) > self.max_tokens:
+            self._discard(next(iter(self._tokens)))
+            self.evictions += 1
+        self._compact()
+
+    def _discard(self, hashed_token):
+        """Removes a token from the table and the user index. Returns its entry, or None."""
+        entry = self._tokens.pop(hashed_token, None)
+        if entry is not None:
+            user_tokens = self._by_user[entry[0]]
+            del user_tokens[hashed_token]
+            if not user_tokens:
+                del self._by_user[entry[0]]
+        return entry
+
+    def _touch(self, hashed_token, username):
+        self._tokens.move_to_end(hashed_token)
+        self._by_user[username].move_to_end(hashed_token)
+
+    def _compact(self):
+        # Removed tokens leave stale heap entries behind; rebuild once they dominate
+        if len(self._heap) > 2 * len(self._tokens) + 64:
+            self._heap = [(entry[1], hashed_token) for hashed_token, entry in self._tokens.items()]
+            heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+class SignedTokenStore:
+    """Stateless tokens: username, client_id, expiry and server_name signed with an HMAC key.
+
+    Verifying a token needs only the key, so memory stays flat under login
+    storms and separate processes sharing the key accept each other's tokens.
+    The server_name claim keeps buildings that share a key from accepting
+    each other's tokens. Tokens cannot be revoked before they expire, so
+    remove() is a no-op.
+    """
+
+    def __init__(self, secret, server_name=None):
+        self._key = secret.encode() if isinstance(secret, str) else secret
+        self.server_name = server_name
+
+    def _sign(self, payload):
+        return hmac.new(self._key, payload, hashlib.sha256).digest()
+
+    def issue(self, username, expiry, client_id=None):
+        claims = {'u': username, 'c': client_id, 'e': int(expiry), 's': self.server_name}
+        payload = json.dumps(claims, separators=(',', ':')).encode()
+        return _b64encode(payload) + '.' + _b64encode(self._sign(payload))
+
+    def get(self, token):
+        try:
+            encoded_payload, encoded_signature = token.split('.')
+            payload = _b64decode(encoded_payload)
+            if not hmac.compare_digest(self._sign(payload), _b64decode(encoded_signature)):
+                return None
+            claims = json.loads(payload)
+            if claims['s'] != self.server_name:
+                return None  # Signed for another building
+            return claims['u'], claims['e'], claims['c']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None  # Malformed or tampered token
+
+    def refresh(self, token, expiry):
+        claims = self.get(token)
+        if claims is None:
+            return None
+        return self.issue(claims[0], expiry, claims[2])  # The old token stays valid until it expires
+
+    def extend(self, token, expiry):
+        return False  # The expiry is part of the signed token
+
+    def remove(self, token):
+        pass
+
+    def expire(self, now=None):
+        return []
+
+    def save(self, path):
+        pass  # Nothing to keep: tokens verify against the key alone
+
+    def load(self, path, now=None):
+        return 0
+
+    def __len__(self):
+        return 0  # Sessions are not tracked
+
+
+class SQLiteTokenStore:
+    """Token table in a local SQLite database (WAL mode) shared between processes.
+
+    Lets several gunicorn workers accept each other's tokens. Each thread gets
+    its own connection; the expiry index keeps expire() proportional to the
+    number of expired rows.
+    """
+
+    SWEEP_INTERVAL = 60  # Seconds between expiry sweeps triggered by issue()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_sweep = 0
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tokens (hash TEXT PRIMARY KEY, username TEXT NOT NULL, expiry REAL NOT NULL, client_id TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS tokens_expiry ON tokens (expiry)")
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def issue(self, username, expiry, client_id=None):
+        token = str(uuid.uuid4())
+        with self._connection() as db:
+            db.execute("INSERT INTO tokens VALUES (?, ?, ?, ?)", (hash_token(token), username, expiry, client_id))
+        if time.time() - self._last_sweep > self.SWEEP_INTERVAL:
+            # Headless workers have no dashboard sweeping for them
+            self.expire()
+        return token
+
+    def get(self, token):
+        row = self._connection().execute(
+            "SELECT username, expiry, client_id FROM tokens WHERE hash = ?", (hash_token(token),)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def refresh(self, token, expiry):
+        new_token = str(uuid.uuid4())
+        with self._connection() as db:
+            # A single UPDATE, so two processes refreshing the same token cannot both succeed
+            cursor = db.execute("UPDATE tokens SET hash = ?, expiry = ? WHERE hash = ?",
+                                (hash_token(new_token), expiry, hash_token(token)))
+        return new_token if cursor.rowcount else None
+
+    def extend(self, token, expiry):
+        with self._connection() as db:
+            cursor = db.execute("UPDATE tokens SET expiry = ? WHERE hash = ?", (expiry, hash_token(token)))
+        return cursor.rowcount > 0
+
+    def remove(self, token):
+        with self._connection() as db:
+            db.execute("DELETE FROM tokens WHERE hash = ?", (hash_token(token),))
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        self._last_sweep = now
+        with self._connection() as db:
+            expired = db.execute("SELECT username FROM tokens WHERE expiry < ?", (now,)).fetchall()
+            if expired:
+                db.execute("DELETE FROM tokens WHERE expiry < ?", (now,))
+        return [row[0] for row in expired]
+
+    def save(self, path):
+        pass  # The database already survives restarts
+
+    def load(self, path, now=None):
+        return 0
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def create_token_store(config):
+    """Builds the token store selected by the "token_mode" key of a server config."""
+    mode = config.get("token_mode", "memory")
+    if mode == "hmac":
+        secret = config.get("token_secret")
+        if not secret:
+            logger.warning("token_mode is 'hmac' but no token_secret is configured; using a random per-process key.")
+            secret = secrets.token_hex(32)
+        return SignedTokenStore(secret, config.get("server_name"))
+    if mode == "sqlite":
+        return SQLiteTokenStore(config.get("token_db", "tokens.db"))
+    if mode != "memory":
+        logger.warning(f"Unknown token_mode '{mode}', using in-memory tokens.")
+    return TokenStore(config.get("max_sessions"), config.get("max_sessions_per_user"))
@@ -0,0 +1,221 @@
+"""Compact binary framing for the UDP protocol, with JSON as the fallback format.
+
+Every binary datagram starts with a fixed header:
+
+    magic (1 byte, 0xB7) | version (1) | message type (1) | reserved (1)
+    building id (4) | request_id (16 raw UUID bytes) | client_id (16)
+
+followed by the fields of the message type. Strings are a 2-byte length plus
+UTF-8; tokens are a kind byte followed by either 16 raw UUID bytes or a
+string (for signed tokens). Action replies may end with the renewed
+expires_in when the server uses sliding expiry. Batches carry a 2-byte count followed by
+length-prefixed inner frames. JSON datagrams always start with '{', so the
+first byte tells the two formats apart.
+
+Clients always start in JSON. A server that understands binary frames adds
+"wire": VERSION to its JSON replies, and only then does a client switch that
+server to binary, so servers without binary support never receive a frame.
+
+encode() and decode() work on the same dicts the JSON protocol uses, so
+callers only swap json.dumps/json.loads for these functions.
+"""
+import json
+import struct
+import uuid
+import zlib
+
+MAGIC = 0xB7
+VERSION = 1
+
+HEADER = struct.Struct('!BBBxI16s16s')
+LENGTH = struct.Struct('!H')
+EXPIRES = struct.Struct('!I')
+
+# Message types
+LOGIN = 1
+ACTION = 2
+BATCH = 3
+REFRESH = 4
+TOKEN = 0x81  # Successful login reply
+MESSAGE = 0x82  # Successful action reply
+ERROR = 0x83
+BATCH_REPLY = 0x84
+
+REQUEST_TYPES = {'login': LOGIN, 'action': ACTION, 'batch': BATCH, 'refresh': REFRESH}
+
+TOKEN_UUID = 0
+TOKEN_STRING = 1
+
+
+def building_id(server_name):
+    """Numeric building id carried instead of the server_name string."""
+    return zlib.crc32(server_name.encode()) if server_name else 0
+
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def _pack_string(value):
+    encoded = value.encode()
+    return LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_string(data, offset):
+    (length,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    end = offset + length
+    if end > len(data):
+        raise ValueError("Truncated string field")
+    return bytes(data[offset:end]).decode(), end
+
+
+def _pack_token(token):
+    try:
+        parsed = uuid.UUID(token)
+    except ValueError:
+        return bytes([TOKEN_STRING]) + _pack_string(token)
+    if str(parsed) != token:
+        return bytes([TOKEN_STRING]) + _pack_string(token)  # Keep non-canonical spellings intact
+    return bytes([TOKEN_UUID]) + parsed.bytes
+
+
+def _unpack_token(data, offset):
+    kind = data[offset]
+    offset += 1
+    if kind == TOKEN_UUID:
+        if offset + 16 > len(data):
+            raise ValueError("Truncated token field")
+        return str(uuid.UUID(bytes=bytes(data[offset:offset + 16]))), offset + 16
+    if kind == TOKEN_STRING:
+        return _unpack_string(data, offset)
+    raise ValueError(f"Unknown token kind {kind}")
+
+
+def _pack_frames(messages, building):
+    frames = [encode(dict(message, building_id=building)) for message in messages]
+    return LENGTH.pack(len(frames)) + b''.join(LENGTH.pack(len(frame)) + frame for frame in frames)
+
+
+def _unpack_frames(data, offset):
+    (count,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    messages = []
+    for _ in range(count):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        if offset + length > len(data):
+            raise ValueError("Truncated batch frame")
+        messages.append(decode(data[offset:offset + length], in_batch=True))
+        offset += length
+    return messages, offset
+
+
+def _uuid_bytes(value):
+    return uuid.UUID(value).bytes if value else bytes(16)
+
+
+def _uuid_string(raw):
+    return str(uuid.UUID(bytes=bytes(raw))) if any(raw) else None
+
+
+def encode(message, server_name=None):
+    """Encodes a request or reply dict as a binary datagram."""
+    if 'building_id' in message:
+        building = message['building_id']
+    else:
+        building = building_id(server_name or message.get('server_name'))
+
+    if 'type' in message:
+        message_type = REQUEST_TYPES[message['type']]
+        if message_type == LOGIN:
+            body = _pack_string(message['username']) + _pack_string(message['password'])
+        elif message_type in (ACTION, REFRESH):
+            body = _pack_token(message['token'])
+        else:
+            body = _pack_frames(message['requests'], building)
+    elif 'responses' in message:
+        message_type = BATCH_REPLY
+        body = _pack_frames(message['responses'], building)
+    elif 'token' in message:
+        message_type = TOKEN
+        body = _pack_token(message['token']) + EXPIRES.pack(int(message.get('expires_in') or 0))
+    elif 'message' in message:
+        message_type = MESSAGE
+        body = _pack_string(message['message'])
+        if 'expires_in' in message:
+            body += EXPIRES.pack(int(message['expires_in']))
+    else:
+        message_type = ERROR
+        body = _pack_string(message.get('error', ''))
+
+    header = HEADER.pack(MAGIC, VERSION, message_type, building,
+                         _uuid_bytes(message.get('request_id')), _uuid_bytes(message.get('client_id')))
+    return header + body
+
+
+def decode(data, in_batch=False):
+    """Decodes a binary datagram into the dict the JSON protocol would carry.
+
+    The server_name is not on the wire; the dict carries 'building_id' instead.
+    Raises ValueError for malformed or unsupported datagrams, including
+    batches nested inside a batch (in_batch is set for inner frames).
+    """
+    try:
+        magic, version, message_type, building, request_id, client_id = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported frame version {version}")
+        if in_batch and message_type in (BATCH, BATCH_REPLY):
+            raise ValueError("Nested batch frame")
+        message = {
+            'request_id': _uuid_string(request_id),
+            'client_id': _uuid_string(client_id),
+            'building_id': building,
+        }
+        offset = HEADER.size
+        if message_type == LOGIN:
+            message['type'] = 'login'
+            message['username'], offset = _unpack_string(data, offset)
+            message['password'], offset = _unpack_string(data, offset)
+        elif message_type == ACTION:
+            message['type'] = 'action'
+            message['token'], offset = _unpack_token(data, offset)
+        elif message_type == REFRESH:
+            message['type'] = 'refresh'
+            message['token'], offset = _unpack_token(data, offset)
+        elif message_type == BATCH:
+            message['type'] = 'batch'
+            message['requests'], offset = _unpack_frames(data, offset)
+        elif message_type == BATCH_REPLY:
+            message['responses'], offset = _unpack_frames(data, offset)
+        elif message_type == TOKEN:
+            message['token'], offset = _unpack_token(data, offset)
+            (message['expires_in'],) = EXPIRES.unpack_from(data, offset)
+        elif message_type == MESSAGE:
+            message['message'], offset = _unpack_string(data, offset)
+            if len(data) - offset >= EXPIRES.size:
+                (message['expires_in'],) = EXPIRES.unpack_from(data, offset)
+        elif message_type == ERROR:
+            message['error'], offset = _unpack_string(data, offset)
+        else:
+            raise ValueError(f"Unknown message type {message_type}")
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed frame: {e}")
+    return message
+
+
+def loads(data):
+    """Decodes a datagram in either format. Returns (message, is_binary)."""
+    if is_binary(data):
+        return decode(data), True
+    try:
+        return json.loads(bytes(data)), False
+    except RecursionError:
+        raise ValueError("JSON nested too deeply")
+
+
+def dumps(message, binary, server_name=None):
+    """Encodes message in the requested format."""
+    if binary:
+        return encode(message, server_name)
+    return json.dumps(message).encode()